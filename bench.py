@@ -0,0 +1,210 @@
+"""Syntetické benchmarky bota (nejsou součástí běhu bota).
+
+    python bench.py logging analytics catchup workers
+"""
+import asyncio
+import atexit
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+from types import SimpleNamespace
+
+import bot
+
+# ============================================================
+# LOGGING
+# ============================================================
+def bench_logging(n_updates: int = 20_000, logs_per_update: int = 3):
+    """Režie logování na update: vypnuto vs. synchronní stream vs. fronta + JSON."""
+    bench = logging.getLogger("dodekaedr.bench")
+
+    def run() -> float:
+        t0 = perf_counter()
+        for i in range(n_updates):
+            bot.log_context.set({"chat_id": i % 500, "command": "/hod"})
+            for j in range(logs_per_update):
+                bench.info("update %s step %s", i, j)
+        return (perf_counter() - t0) / n_updates * 1e6
+
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    with tempfile.TemporaryFile("w") as sink:
+        try:
+            root.setLevel(logging.CRITICAL)
+            off = run()
+
+            sync = logging.StreamHandler(sink)
+            sync.setFormatter(logging.Formatter(bot.LOG_TEXT_FORMAT))
+            root.handlers[:] = [sync]
+            root.setLevel(logging.INFO)
+            sync_us = run()
+
+            listener = bot.setup_logging(sink)
+            root.setLevel(logging.INFO)
+            queued = run()
+            listener.stop()
+            atexit.unregister(listener.stop)
+        finally:
+            root.handlers[:] = saved_handlers
+            root.setLevel(saved_level)
+
+    print(f"per update ({logs_per_update} INFO logs): disabled {off:.1f}us, "
+          f"sync stream {sync_us:.1f}us, queue+json {queued:.1f}us")
+
+# ============================================================
+# ANALYTICS (vyžaduje numpy)
+# ============================================================
+def bench_analytics(n_rows: int = 10_000_000, n_users: int = 200_000, days: int = 730):
+    """Reporty nad mmap snapshotem se syntetickými sloupci."""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    cols = {
+        "chat": rng.integers(0, n_users, n_rows, dtype=np.int32),
+        "day": rng.integers(20000, 20000 + days, n_rows, dtype=np.int32),
+        "number": rng.integers(1, 13, n_rows, dtype=np.int8),
+        "mode": rng.integers(0, len(bot.MODES), n_rows, dtype=np.int8),
+        "verdict": rng.integers(0, 3, n_rows, dtype=np.int8),
+        "vmin": rng.integers(-1, 1440, n_rows, dtype=np.int16),
+        "users": np.arange(n_users, dtype=np.int64),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, arr in cols.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), arr)
+        del cols
+        snap = bot.analytics_load(tmp)
+        for name, fn in (
+            ("retention", bot.analytics_retention),
+            ("plane_mode", bot.analytics_plane_mode),
+            ("verdict_hours", bot.analytics_verdict_hours),
+            ("weekdays", bot.analytics_weekdays),
+            ("report", bot.analytics_report),
+        ):
+            t0 = perf_counter()
+            fn(snap)
+            print(f"{name:<14} {n_rows:>11} rows  {perf_counter() - t0:7.3f}s")
+
+# ============================================================
+# CATCH-UP
+# ============================================================
+def bench_catchup(n_updates: int = 50_000, n_chats: int = 5_000, handler_ms: float = 2.0, n_live: int = 200):
+    """Syntetický backlog přes CatchUpProcessor + živé updaty během drainu."""
+    rng = random.Random(0)
+    commands = ["/dnes", "/dnes", "/hod", "/hod", "/historie", "/stat", "/cas 07:00 21:00"]
+    callbacks = ["v:OBSTÁL", "v:UHNUL", "pick:TVRDÝ", "pick:ZÁKLADNÍ", "accept", "verdict"]
+
+    def fake_update(i: int):
+        chat = SimpleNamespace(id=rng.randrange(n_chats))
+        if rng.random() < 0.6:
+            return SimpleNamespace(update_id=i, effective_chat=chat,
+                                   message=SimpleNamespace(text=rng.choice(commands)), callback_query=None)
+        return SimpleNamespace(update_id=i, effective_chat=chat,
+                               message=None, callback_query=SimpleNamespace(data=rng.choice(callbacks)))
+
+    async def handler():
+        await asyncio.sleep(handler_ms / 1000)
+
+    async def live(proc, u, latencies):
+        t0 = perf_counter()
+        await proc.do_process_update(u, handler())
+        latencies.append(perf_counter() - t0)
+
+    async def run():
+        proc = bot.CatchUpProcessor()
+        await proc.initialize()
+        proc.start_backlog(n_updates)
+        tasks = [asyncio.create_task(proc.do_process_update(fake_update(i), handler())) for i in range(n_updates)]
+        await asyncio.sleep(0.5)
+        latencies: list[float] = []
+        for i in range(n_live):
+            u = fake_update(n_updates + i)
+            u.effective_chat.id = n_chats + i  # chaty bez backlogu
+            tasks.append(asyncio.create_task(live(proc, u, latencies)))
+            await asyncio.sleep(0.005)
+        await asyncio.gather(*tasks)
+        return proc.stats, latencies
+
+    stats, latencies = asyncio.run(run())
+    latencies.sort()
+    print(
+        f"backlog {stats['backlog']} updates: processed {stats['processed']} "
+        f"({stats['coalesced']} coalesced), drain {stats['drain_s']:.2f}s "
+        f"vs sequential ~{n_updates * handler_ms / 1000:.0f}s; "
+        f"live p50 {latencies[len(latencies) // 2] * 1000:.1f}ms p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms"
+    )
+    return stats
+
+# ============================================================
+# SHARDED WORKERS
+# ============================================================
+def _shard_worker(q, done):
+    # CPU práce jednoho updatu: vykreslení scénáře, klávesnic a statistiky
+    n = 0
+    agg = bot._empty_agg()
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        chat_id, number = item
+        mode = bot.MODES[chat_id % len(bot.MODES)]
+        bot.format_scenario(mode, number)
+        bot.mode_keyboard()
+        for _ in range(40):
+            bot._agg_add_roll(agg, bot.PLANES[number], mode, "UHNUL" if chat_id % 2 else "OBSTÁL")
+        bot.format_stat_window(agg, 30, False)
+        json.dumps({"chat_id": chat_id, "text": bot.format_scenario(mode, number)})
+        n += 1
+    done.put(n)
+
+def bench_workers(n_updates: int = 200_000, worker_counts=(1, 2, 4), n_chats: int = 10_000):
+    """Propustnost front -> N workerů (fronty a shard_for jako v run_sharded)."""
+    ctx = multiprocessing.get_context("spawn")
+    rng = random.Random(0)
+    items = [(rng.randrange(n_chats), rng.randrange(1, 13)) for _ in range(n_updates)]
+    base = None
+    for n in worker_counts:
+        queues = [ctx.Queue() for _ in range(n)]
+        done = ctx.Queue()
+        procs = [ctx.Process(target=_shard_worker, args=(q, done), daemon=True) for q in queues]
+        for p in procs:
+            p.start()
+        t0 = perf_counter()
+        for chat_id, number in items:
+            queues[bot.shard_for(chat_id, n)].put((chat_id, number))
+        for q in queues:
+            q.put(None)
+        total = sum(done.get() for _ in procs)
+        elapsed = perf_counter() - t0
+        for p in procs:
+            p.join()
+        rate = total / elapsed
+        base = base or rate
+        print(f"workers={n}: {total} updates in {elapsed:.2f}s = {rate:,.0f}/s (x{rate / base:.2f}), "
+              f"cpus={os.cpu_count()}")
+
+# ============================================================
+# MAIN
+# ============================================================
+BENCHES = {
+    "logging": bench_logging,
+    "analytics": bench_analytics,
+    "catchup": bench_catchup,
+    "workers": bench_workers,
+}
+
+def main(argv: list[str]):
+    names = argv or list(BENCHES)
+    unknown = [n for n in names if n not in BENCHES]
+    if unknown:
+        raise SystemExit(f"neznámý benchmark: {', '.join(unknown)} (k dispozici: {', '.join(BENCHES)})")
+    for name in names:
+        print(f"== {name}")
+        BENCHES[name]()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
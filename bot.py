@@ -1,39 +1,153 @@
+from time import perf_counter, time as unix_time
+_PROCESS_T0 = perf_counter()
+
 import os
 import sqlite3
 import threading
 import http.server
 import socketserver
 import logging
+import logging.handlers
+import queue
+import atexit
 import secrets
-from datetime import datetime, time
+import json
+import asyncio
+import tempfile
+import shutil
+import multiprocessing
+import contextvars
+import functools
+import random
+import signal
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, time, timedelta
 from zoneinfo import ZoneInfo
 from html import escape as h
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.constants import ParseMode
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    CallbackQueryHandler,
-    ContextTypes,
-)
-
 # ============================================================
-# LOGGING
+# LOGGING (fronta + zápis ve vlákně, mimo event loop)
 # ============================================================
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
-)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+LOG_TEXT_FORMAT = "%(asctime)s | %(levelname)s | %(name)s | %(message)s"
+# Opakované stejné warningy/chyby: max LOG_REPEAT_BURST za LOG_REPEAT_WINDOW sekund, zbytek se jen spočítá.
+LOG_REPEAT_WINDOW = float(os.getenv("LOG_REPEAT_WINDOW", "60") or 60)
+LOG_REPEAT_BURST = int(os.getenv("LOG_REPEAT_BURST", "5") or 5)
+
+# chat_id / command aktuálního updatu; nastavuje se v handleru skupiny -2
+log_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class RepeatFilter(logging.Filter):
+    """Tlumí opakované stejné záznamy od WARNING výš (stejný logger, text zprávy i výjimka).
+
+    Klíčem je zformátovaná zpráva, ne šablona: různé chat_id / chyby se tlumí zvlášť.
+    Trace logger (dumpy pomalých updatů) se netlumí vůbec.
+    """
+
+    EXEMPT = ("dodekaedr.trace",)
+
+    def __init__(self, window: float, burst: int):
+        super().__init__()
+        self._window = window
+        self._burst = burst
+        self._seen: dict[tuple, list] = {}  # key -> [window_start, count, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or record.name in self.EXEMPT:
+            return True
+        exc = record.exc_info[1] if record.exc_info else None
+        key = (
+            record.name,
+            record.levelno,
+            record.getMessage(),
+            type(exc).__name__ if exc is not None else None,
+            str(exc) if exc is not None else None,
+        )
+        now = unix_time()
+        with self._lock:
+            st = self._seen.get(key)
+            if st is None or now - st[0] >= self._window:
+                if len(self._seen) > 1000:
+                    self._seen.clear()
+                suppressed = st[2] if st else 0
+                self._seen[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            st[1] += 1
+            if st[1] <= self._burst:
+                return True
+            st[2] += 1
+            return False
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ("worker", "chat_id", "command", "update_id", "suppressed")
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in self.FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                out[key] = value
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+class LoopSafeQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # jen sloučit argumenty; formátování (vč. tracebacku) proběhne ve vlákně listeneru
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging(stream=None) -> logging.handlers.QueueListener:
+    out = logging.StreamHandler(stream)
+    out.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT))
+
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    qh = LoopSafeQueueHandler(q)
+    qh.addFilter(ContextFilter())
+    qh.addFilter(RepeatFilter(LOG_REPEAT_WINDOW, LOG_REPEAT_BURST))
+
+    root = logging.getLogger()
+    root.handlers[:] = [qh]
+    root.setLevel(LOG_LEVEL)
+    # httpx loguje každý request na INFO => tisíce řádků při dávce připomínek
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(q, out, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+LOG_LISTENER = setup_logging()
 log = logging.getLogger("dodekaedr")
 
 # ============================================================
 # CONFIG
 # ============================================================
-TZ = ZoneInfo("Europe/Prague")
+TZ_NAME = "Europe/Prague"
+TZ = ZoneInfo(TZ_NAME)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 DB_PATH = os.getenv("DB_PATH", "/var/data/dodekaedr.db")
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", os.path.join(os.path.dirname(DB_PATH), "analytics"))
 
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "stangzk").strip().lower()
 
@@ -42,6 +156,62 @@ EVENING_DEFAULT = "21:00"
 
 APP_LINK = os.getenv("APP_LINK", "").strip()
 
+def _env_int(name: str, default: int) -> int:
+    raw = os.getenv(name, "").strip()
+    return int(raw) if raw else default
+
+def _env_float(name: str, default: float) -> float:
+    raw = os.getenv(name, "").strip()
+    return float(raw) if raw else default
+
+def _env_bool(name: str, default: bool) -> bool:
+    raw = os.getenv(name, "").strip().lower()
+    if not raw:
+        return default
+    return raw in ("1", "true", "yes", "on")
+
+# Bot API transport: odeslání (send_message, answer, edit...) a getUpdates mají oddělené pooly,
+# aby dávka připomínek nezablokovala long-polling a naopak.
+TG_POOL_SIZE = _env_int("TG_POOL_SIZE", 64)
+TG_UPDATES_POOL_SIZE = _env_int("TG_UPDATES_POOL_SIZE", 2)
+TG_KEEPALIVE = _env_int("TG_KEEPALIVE", TG_POOL_SIZE)
+TG_KEEPALIVE_EXPIRY = _env_float("TG_KEEPALIVE_EXPIRY", 30.0)
+TG_HTTP2 = _env_bool("TG_HTTP2", False)
+TG_CONNECT_TIMEOUT = _env_float("TG_CONNECT_TIMEOUT", 5.0)
+TG_READ_TIMEOUT = _env_float("TG_READ_TIMEOUT", 10.0)
+TG_WRITE_TIMEOUT = _env_float("TG_WRITE_TIMEOUT", 10.0)
+TG_POOL_TIMEOUT = _env_float("TG_POOL_TIMEOUT", 5.0)
+TG_POLL_TIMEOUT = _env_int("TG_POLL_TIMEOUT", 30)
+
+# Hromadná zpráva: Telegram snese ~30 zpráv/s na bota, necháváme rezervu pro běžný provoz.
+BROADCAST_RATE = _env_float("BROADCAST_RATE", 20.0)
+BROADCAST_CONCURRENCY = _env_int("BROADCAST_CONCURRENCY", 8)
+BROADCAST_BATCH = _env_int("BROADCAST_BATCH", 200)
+
+# Souběh updatů: živé a backlogové mají oddělené limity, součet má zůstat pod TG_POOL_SIZE,
+# jinak handlery čekají na spojení z poolu (TG_POOL_TIMEOUT).
+UPDATE_CONCURRENCY = _env_int("UPDATE_CONCURRENCY", 16)
+# Catch-up po výpadku: od této velikosti backlogu se čekající updaty slučují a mají nižší prioritu než živé.
+CATCHUP_MIN_BACKLOG = _env_int("CATCHUP_MIN_BACKLOG", 100)
+CATCHUP_CONCURRENCY = _env_int("CATCHUP_CONCURRENCY", 16)
+
+# Tracing pomalých updatů: 0 = vypnuto. Profil (pyinstrument, je-li nainstalovaný) jen pro vzorek updatů.
+TRACE_SLOW_MS = _env_float("TRACE_SLOW_MS", 0.0)
+TRACE_PROFILE_SAMPLE = _env_float("TRACE_PROFILE_SAMPLE", 0.0)
+
+# WORKERS > 1: front proces pollinguje a posílá updaty do N worker procesů podle chat_id.
+WORKERS = _env_int("WORKERS", 0)
+WORKER_QUEUE_SIZE = _env_int("WORKER_QUEUE_SIZE", 10_000)
+# plná fronta workeru: front čeká po WORKER_PUT_TIMEOUT s, po WORKER_STALL_S to vzdá a skončí
+WORKER_PUT_TIMEOUT = _env_float("WORKER_PUT_TIMEOUT", 5.0)
+WORKER_STALL_S = _env_float("WORKER_STALL_S", 120.0)
+
+# Outbox: odpovědi zapsané v transakci se změnou stavu, odesílá je background sender.
+OUTBOX_POLL = _env_float("OUTBOX_POLL", 0.5)
+OUTBOX_BATCH = _env_int("OUTBOX_BATCH", 50)
+OUTBOX_MAX_ATTEMPTS = _env_int("OUTBOX_MAX_ATTEMPTS", 8)
+OUTBOX_KEEP_SENT_S = _env_int("OUTBOX_KEEP_SENT_S", 86_400)
+
 MODES = ["ZÁKLADNÍ", "TVRDÝ", "LEGIONÁŘSKÝ"]
 
 PLANES = {
@@ -104,14 +274,78 @@ SCENARIOS = {
     },
 }
 
+# ============================================================
+# STARTUP TIMING
+# ============================================================
+class StartupTimer:
+    """Měří fáze startu od spuštění procesu až po první přijatý update."""
+
+    def __init__(self, t0: float):
+        self._t0 = t0
+        self._last = t0
+        self._phases: list[tuple[str, float]] = []
+        self._parallel: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def mark(self, phase: str):
+        now = perf_counter()
+        with self._lock:
+            self._phases.append((phase, now - self._last))
+            self._last = now
+
+    def note(self, phase: str, seconds: float):
+        """Fáze běžící souběžně s jinými (nepřičítá se do sekvence)."""
+        with self._lock:
+            self._parallel[phase] = seconds
+
+    def elapsed(self) -> float:
+        return perf_counter() - self._t0
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            out = {name: round(sec * 1000, 1) for name, sec in self._phases}
+            out.update({f"{name}(par)": round(sec * 1000, 1) for name, sec in self._parallel.items()})
+            out["total_ms"] = round((self._last - self._t0) * 1000, 1)
+        return out
+
+    def report(self) -> str:
+        d = self.as_dict()
+        total = d.pop("total_ms")
+        parts = [f"{name}={ms:.0f}ms" for name, ms in d.items()]
+        return f"startup {total:.0f}ms | " + " ".join(parts)
+
+STARTUP = StartupTimer(_PROCESS_T0)
+
 # ============================================================
 # HEALTH SERVER (PORT binding)
 # ============================================================
+# sekce /metrics: název -> funkce vracející dict (registrují se postupně při načítání modulu)
+METRICS: dict[str, object] = {"startup": STARTUP.as_dict}
+
+_health_httpd = None
+
 def start_health_server():
+    global _health_httpd
+    if _health_httpd is not None:
+        return
     port = int(os.getenv("PORT", "10000"))
 
+    def section(fn):
+        # port je nahoře dřív než init_db: sekce nad DB může selhat, ostatní ať se vrátí
+        try:
+            return fn()
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
     class Handler(http.server.BaseHTTPRequestHandler):
         def do_GET(self):
+            if self.path == "/metrics":
+                body = json.dumps({name: section(fn) for name, fn in list(METRICS.items())}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+                return
             self.send_response(200)
             self.end_headers()
             self.wfile.write(b"OK")
@@ -119,14 +353,251 @@ def start_health_server():
         def log_message(self, fmt, *args):
             return
 
-    httpd = socketserver.TCPServer(("", port), Handler)
-    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    socketserver.TCPServer.allow_reuse_address = True
+    _health_httpd = socketserver.TCPServer(("", port), Handler)
+    threading.Thread(target=_health_httpd.serve_forever, daemon=True).start()
+
+# Port bindujeme hned, ještě před načtením telegram stacku (platforma měří čas do bindu).
+if __name__ == "__main__":
+    STARTUP.mark("stdlib_import")
+    start_health_server()
+    STARTUP.mark("health_bind")
+
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    CallbackQueryHandler,
+    ContextTypes,
+    TypeHandler,
+    BaseUpdateProcessor,
+)
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+# ============================================================
+# BOT API TRANSPORT + METRICS
+# ============================================================
+class ApiMetrics:
+    """Latence a chyby po jednotlivých metodách Bot API (sendMessage, getUpdates, ...)."""
+
+    SAMPLE_SIZE = 512
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: dict[str, dict] = {}
+
+    def record(self, endpoint: str, seconds: float, error: str | None = None):
+        with self._lock:
+            st = self._stats.get(endpoint)
+            if st is None:
+                st = {"calls": 0, "errors": {}, "total_s": 0.0, "max_s": 0.0,
+                      "samples": deque(maxlen=self.SAMPLE_SIZE)}
+                self._stats[endpoint] = st
+            st["calls"] += 1
+            st["total_s"] += seconds
+            st["max_s"] = max(st["max_s"], seconds)
+            st["samples"].append(seconds)
+            if error:
+                st["errors"][error] = st["errors"].get(error, 0) + 1
+
+    def snapshot(self) -> dict:
+        out = {}
+        with self._lock:
+            for endpoint, st in self._stats.items():
+                samples = sorted(st["samples"])
+                def pct(q: float) -> float:
+                    return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+                out[endpoint] = {
+                    "calls": st["calls"],
+                    "errors": sum(st["errors"].values()),
+                    "error_kinds": dict(st["errors"]),
+                    "avg_ms": round(st["total_s"] / st["calls"] * 1000, 1) if st["calls"] else 0.0,
+                    "p50_ms": round(pct(0.50) * 1000, 1),
+                    "p95_ms": round(pct(0.95) * 1000, 1),
+                    "max_ms": round(st["max_s"] * 1000, 1),
+                }
+        return out
+
+API_METRICS = ApiMetrics()
+METRICS["bot_api"] = API_METRICS.snapshot
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, který měří každé volání Bot API podle názvu metody."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        t0 = perf_counter()
+        error = None
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            if not 200 <= code < 300:
+                error = f"HTTP {code}"
+            return code, payload
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            t1 = perf_counter()
+            API_METRICS.record(endpoint, t1 - t0, error)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add("api", endpoint, t0, t1, **({"error": error} if error else {}))
+
+def build_request(pool_size: int) -> HTTPXRequest:
+    import httpx
+
+    return InstrumentedRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=TG_CONNECT_TIMEOUT,
+        read_timeout=TG_READ_TIMEOUT,
+        write_timeout=TG_WRITE_TIMEOUT,
+        pool_timeout=TG_POOL_TIMEOUT,
+        http_version="2" if TG_HTTP2 else "1.1",
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=min(TG_KEEPALIVE, pool_size),
+                keepalive_expiry=TG_KEEPALIVE_EXPIRY,
+            ),
+        },
+    )
+
+# ============================================================
+# TRACING (pomalé updaty)
+# ============================================================
+TRACE_MAX_SPANS = 500
+trace_log = logging.getLogger("dodekaedr.trace")
+
+class Trace:
+    """Spany jednoho updatu: handler, SQL příkazy a volání Bot API."""
+
+    __slots__ = ("t0", "update_id", "chat_id", "handler", "spans", "dropped", "profiler")
+
+    def __init__(self, update: object):
+        self.t0 = perf_counter()
+        self.update_id = getattr(update, "update_id", None)
+        chat = getattr(update, "effective_chat", None)
+        self.chat_id = chat.id if chat is not None else None
+        self.handler = None
+        self.spans: list[dict] = []
+        self.dropped = 0
+        self.profiler = None
+
+    def add(self, kind: str, name: str, start: float, end: float, **extra):
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return
+        span = {"kind": kind, "name": name,
+                "at_ms": round((start - self.t0) * 1000, 2), "ms": round((end - start) * 1000, 2)}
+        span.update(extra)
+        self.spans.append(span)
+
+    def as_dict(self, total_s: float) -> dict:
+        by_kind: dict[str, dict] = {}
+        for sp in self.spans:
+            k = by_kind.setdefault(sp["kind"], {"count": 0, "ms": 0.0})
+            k["count"] += 1
+            k["ms"] = round(k["ms"] + sp["ms"], 2)
+        return {
+            "update_id": self.update_id,
+            "chat_id": self.chat_id,
+            "handler": self.handler,
+            "total_ms": round(total_s * 1000, 2),
+            "summary": by_kind,
+            "spans": self.spans,
+            "dropped_spans": self.dropped,
+        }
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+
+def _start_profiler():
+    if TRACE_PROFILE_SAMPLE <= 0 or random.random() >= TRACE_PROFILE_SAMPLE:
+        return None
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        return None
+    profiler = Profiler(async_mode="enabled")
+    profiler.start()
+    return profiler
+
+class TracingApplication(Application):
+    """Application, která každý update obalí tracem a pomalé vypíše do logu."""
+
+    async def process_update(self, update: object) -> None:
+        trace = Trace(update)
+        trace.profiler = _start_profiler()
+        token = _current_trace.set(trace)
+        try:
+            await super().process_update(update)
+        finally:
+            _current_trace.reset(token)
+            total = perf_counter() - trace.t0
+            profile_text = None
+            if trace.profiler is not None:
+                trace.profiler.stop()
+                if total * 1000 >= TRACE_SLOW_MS:
+                    profile_text = trace.profiler.output_text(unicode=False, color=False)
+            if total * 1000 >= TRACE_SLOW_MS:
+                trace_log.warning("slow update %s", json.dumps(trace.as_dict(total), ensure_ascii=False))
+                if profile_text:
+                    trace_log.warning("slow update %s profile:\n%s", trace.update_id, profile_text)
+
+def traced(handler):
+    """Span pro handler (cmd_*, on_callback podle větve callback_data)."""
+    if TRACE_SLOW_MS <= 0:
+        return handler
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        trace = _current_trace.get()
+        if trace is None:
+            return await handler(update, context)
+        name = handler.__name__
+        query = getattr(update, "callback_query", None)
+        if query is not None and query.data:
+            name = f"{name}:{query.data.split(':', 1)[0]}"
+        trace.handler = name
+        t0 = perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            trace.add("handler", name, t0, perf_counter())
+
+    return wrapper
+
+class TracedConnection(sqlite3.Connection):
+    """sqlite3 spojení, které při aktivním trace měří každý příkaz i s názvem volajícího helperu."""
+
+    def execute(self, sql, parameters=(), /):
+        trace = _current_trace.get()
+        if trace is None:
+            return super().execute(sql, parameters)
+        caller = sys._getframe(1).f_code.co_name
+        t0 = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            trace.add("sql", caller, t0, perf_counter(), sql=" ".join(sql.split())[:160])
+
+    def executemany(self, sql, seq_of_parameters, /):
+        trace = _current_trace.get()
+        if trace is None:
+            return super().executemany(sql, seq_of_parameters)
+        caller = sys._getframe(1).f_code.co_name
+        t0 = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            trace.add("sql", caller, t0, perf_counter(), sql=" ".join(sql.split())[:160])
 
 # ============================================================
 # DB
 # ============================================================
 def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn = sqlite3.connect(DB_PATH, timeout=30, factory=TracedConnection if TRACE_SLOW_MS > 0 else sqlite3.Connection)
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA foreign_keys=ON;")
     return conn
@@ -135,18 +606,32 @@ def _table_columns(conn: sqlite3.Connection, table: str) -> set[str]:
     rows = conn.execute(f"PRAGMA table_info({table});").fetchall()
     return {r[1] for r in rows}
 
+# Zvýšit při každé změně schématu v init_db(); při shodě se introspekce přeskočí.
+SCHEMA_VERSION = 7
+
 def init_db():
     with db() as conn:
+        if conn.execute("PRAGMA user_version;").fetchone()[0] >= SCHEMA_VERSION:
+            return
+
         conn.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 chat_id INTEGER PRIMARY KEY,
                 mode TEXT NOT NULL DEFAULT 'ZÁKLADNÍ',
                 morning_time TEXT NOT NULL DEFAULT '07:00',
                 evening_time TEXT NOT NULL DEFAULT '21:00',
-                is_enabled INTEGER NOT NULL DEFAULT 1
+                is_enabled INTEGER NOT NULL DEFAULT 1,
+                timezone TEXT DEFAULT NULL,
+                disabled_reason TEXT DEFAULT NULL
             )
         """)
 
+        user_cols = _table_columns(conn, "users")
+        if "timezone" not in user_cols:
+            conn.execute("ALTER TABLE users ADD COLUMN timezone TEXT DEFAULT NULL;")
+        if "disabled_reason" not in user_cols:
+            conn.execute("ALTER TABLE users ADD COLUMN disabled_reason TEXT DEFAULT NULL;")
+
         # Kompatibilita:
         # - starší DB může mít rolls.mode jako NOT NULL
         # - scenario_mode je uzamčený režim dne
@@ -161,6 +646,7 @@ def init_db():
                 pending INTEGER NOT NULL DEFAULT 1,
                 verdict TEXT DEFAULT NULL,
                 rolled_at TEXT NOT NULL,
+                verdict_at TEXT DEFAULT NULL,
                 PRIMARY KEY(chat_id, day)
             )
         """)
@@ -181,6 +667,65 @@ def init_db():
             conn.execute("ALTER TABLE rolls ADD COLUMN verdict TEXT DEFAULT NULL;")
         if "rolled_at" not in cols:
             conn.execute("ALTER TABLE rolls ADD COLUMN rolled_at TEXT NOT NULL DEFAULT '';")
+        if "verdict_at" not in cols:
+            conn.execute("ALTER TABLE rolls ADD COLUMN verdict_at TEXT DEFAULT NULL;")
+
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rolls_day ON rolls(day);")
+
+        # Denní agregace (rollup) pro /stat N; chat_id=0 je globální řádek.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                chat_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                rolls INTEGER NOT NULL,
+                obstal INTEGER NOT NULL,
+                uhnul INTEGER NOT NULL,
+                uhnul_planes TEXT NOT NULL DEFAULT '{}',
+                modes TEXT NOT NULL DEFAULT '{}',
+                PRIMARY KEY(chat_id, day)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+        """)
+
+        # Hromadné zprávy: cursor = poslední zpracované chat_id (keyset), checkpoint po dávkách.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                cursor INTEGER NOT NULL DEFAULT -9223372036854775808,
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                active_s REAL NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                finished_at TEXT DEFAULT NULL
+            )
+        """)
+
+        # Outbox: idem_key brání dvojímu zařazení téže odpovědi (např. opakované zpracování updatu).
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                idem_key TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                next_at REAL NOT NULL,
+                sent_at REAL DEFAULT NULL,
+                last_error TEXT DEFAULT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_at);")
+
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION};")
 
 def upsert_user(chat_id: int):
     with db() as conn:
@@ -191,14 +736,22 @@ def upsert_user(chat_id: int):
 
 def get_user(chat_id: int):
     with db() as conn:
-        return conn.execute(
-            "SELECT chat_id, mode, morning_time, evening_time, is_enabled FROM users WHERE chat_id=?",
+        row = conn.execute(
+            """
+            SELECT chat_id, mode, morning_time, evening_time, is_enabled, timezone, disabled_reason
+            FROM users WHERE chat_id=?
+            """,
             (chat_id,),
         ).fetchone()
+    if row:
+        _user_tz[chat_id] = row[5] or TZ_NAME
+    return row
 
-def set_user_mode(chat_id: int, mode: str):
+def set_user_mode(chat_id: int, mode: str, outbox: list[tuple[str, dict]] = ()):
     with db() as conn:
         conn.execute("UPDATE users SET mode=? WHERE chat_id=?", (mode, chat_id))
+        for idem_key, payload in outbox:
+            outbox_add(conn, chat_id, idem_key, payload)
 
 def set_user_times(chat_id: int, morning: str, evening: str):
     with db() as conn:
@@ -207,18 +760,80 @@ def set_user_times(chat_id: int, morning: str, evening: str):
             (morning, evening, chat_id),
         )
 
-def set_user_enabled(chat_id: int, enabled: bool):
+def set_user_enabled(chat_id: int, enabled: bool, reason: str | None = None):
     with db() as conn:
         conn.execute(
-            "UPDATE users SET is_enabled=? WHERE chat_id=?",
-            (1 if enabled else 0, chat_id),
+            "UPDATE users SET is_enabled=?, disabled_reason=? WHERE chat_id=?",
+            (1 if enabled else 0, None if enabled else reason, chat_id),
         )
 
-def today_str() -> str:
-    return datetime.now(TZ).date().isoformat()
+def stats_unreachable_total() -> int:
+    with db() as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM users WHERE is_enabled=0 AND disabled_reason='unreachable'"
+        ).fetchone()[0]
+
+def set_user_timezone(chat_id: int, tz_name: str | None):
+    with db() as conn:
+        conn.execute("UPDATE users SET timezone=? WHERE chat_id=?", (tz_name, chat_id))
+    _user_tz[chat_id] = tz_name or TZ_NAME
+
+# ============================================================
+# DAY KEY (per-user timezone)
+# ============================================================
+class DayKeyService:
+    """Dnešní den (YYYY-MM-DD) pro každou zónu, přepočítaný až o půlnoci té zóny."""
+
+    def __init__(self):
+        self._zones: dict[str, ZoneInfo] = {}
+        self._days: dict[str, tuple[str, float]] = {}
+
+    def zone(self, tz_name: str) -> ZoneInfo:
+        tz = self._zones.get(tz_name)
+        if tz is None:
+            tz = ZoneInfo(tz_name)
+            self._zones[tz_name] = tz
+        return tz
+
+    def today(self, tz_name: str) -> str:
+        cached = self._days.get(tz_name)
+        if cached and unix_time() < cached[1]:
+            return cached[0]
+
+        tz = self.zone(tz_name)
+        today = datetime.now(tz).date()
+        next_midnight = datetime.combine(today + timedelta(days=1), time(0), tzinfo=tz)
+        day = today.isoformat()
+        self._days[tz_name] = (day, next_midnight.timestamp())
+        return day
+
+DAY_KEYS = DayKeyService()
+
+# chat_id -> název zóny; plní se z get_user()/set_user_timezone(), jinak líně z DB
+_user_tz: dict[int, str] = {}
+
+def user_tz(chat_id: int) -> str:
+    tz_name = _user_tz.get(chat_id)
+    if tz_name is None:
+        with db() as conn:
+            row = conn.execute("SELECT timezone FROM users WHERE chat_id=?", (chat_id,)).fetchone()
+        tz_name = (row[0] if row else None) or TZ_NAME
+        _user_tz[chat_id] = tz_name
+    return tz_name
+
+def valid_tz(tz_name: str) -> bool:
+    try:
+        DAY_KEYS.zone(tz_name)
+        return True
+    except Exception:
+        return False
+
+def today_str(chat_id: int | None = None) -> str:
+    return DAY_KEYS.today(TZ_NAME if chat_id is None else user_tz(chat_id))
 
-def now_iso() -> str:
-    return datetime.now(TZ).isoformat(timespec="seconds")
+def now_iso(chat_id: int | None = None) -> str:
+    tz = TZ if chat_id is None else DAY_KEYS.zone(user_tz(chat_id))
+    return datetime.now(tz).isoformat(timespec="seconds")
 
 def get_today_roll(chat_id: int):
     with db() as conn:
@@ -228,7 +843,7 @@ def get_today_roll(chat_id: int):
             FROM rolls
             WHERE chat_id=? AND day=?
             """,
-            (chat_id, today_str()),
+            (chat_id, today_str(chat_id)),
         ).fetchone()
 
 def is_pending_today(chat_id: int) -> bool:
@@ -255,7 +870,7 @@ def save_pending_roll(chat_id: int, number: int):
                 (?, ?, ?, ?, ?, NULL, 1, NULL, ?)
             ON CONFLICT(chat_id, day) DO NOTHING
             """,
-            (chat_id, today_str(), number, plane, user_mode, now_iso()),
+            (chat_id, today_str(chat_id), number, plane, user_mode, now_iso(chat_id)),
         )
 
 def ensure_today_roll(chat_id: int) -> tuple[int, str]:
@@ -274,7 +889,8 @@ def ensure_today_roll(chat_id: int) -> tuple[int, str]:
 
     return int(number), PLANES[int(number)]
 
-def finalize_roll_mode(chat_id: int, chosen_mode: str):
+def finalize_roll_mode(chat_id: int, chosen_mode: str, outbox: list[tuple[str, dict]] = ()):
+    """Uzamkne tón dne a nastaví ho jako výchozí; `outbox` zprávy se zařadí ve stejné transakci."""
     with db() as conn:
         conn.execute(
             """
@@ -282,31 +898,87 @@ def finalize_roll_mode(chat_id: int, chosen_mode: str):
             SET scenario_mode=?, mode=?, pending=0
             WHERE chat_id=? AND day=?
             """,
-            (chosen_mode, chosen_mode, chat_id, today_str()),
+            (chosen_mode, chosen_mode, chat_id, today_str(chat_id)),
         )
+        conn.execute("UPDATE users SET mode=? WHERE chat_id=?", (chosen_mode, chat_id))
+        for idem_key, payload in outbox:
+            outbox_add(conn, chat_id, idem_key, payload)
 
-def set_verdict(chat_id: int, verdict: str):
+def set_verdict(chat_id: int, verdict: str, outbox: list[tuple[str, dict]] = ()):
     with db() as conn:
         conn.execute(
             """
             UPDATE rolls
-            SET verdict=?
+            SET verdict=?, verdict_at=?
             WHERE chat_id=? AND day=?
             """,
-            (verdict, chat_id, today_str()),
+            (verdict, now_iso(chat_id), chat_id, today_str(chat_id)),
         )
+        for idem_key, payload in outbox:
+            outbox_add(conn, chat_id, idem_key, payload)
+
+HISTORY_PAGE = 12
+
+def history_page(chat_id: int, before: str | None = None, after: str | None = None):
+    """Keyset stránka po (chat_id, day): (rows od nejnovějšího, has_older, has_newer).
 
-def last_12(chat_id: int):
+    before = starší než den, after = novější než den, nic = nejnovější stránka.
+    """
     with db() as conn:
-        return conn.execute(
+        if after is not None:
+            rows = conn.execute(
+                """
+                SELECT day, number, plane, verdict
+                FROM rolls
+                WHERE chat_id=? AND day>?
+                ORDER BY day ASC
+                LIMIT ?
+                """,
+                (chat_id, after, HISTORY_PAGE + 1),
+            ).fetchall()
+            has_newer = len(rows) > HISTORY_PAGE
+            rows = rows[:HISTORY_PAGE][::-1]
+            if not rows:
+                return history_page(chat_id)
+            has_older = conn.execute(
+                "SELECT 1 FROM rolls WHERE chat_id=? AND day<? LIMIT 1",
+                (chat_id, rows[-1][0]),
+            ).fetchone() is not None
+            return rows, has_older, has_newer
+
+        rows = conn.execute(
             """
             SELECT day, number, plane, verdict
             FROM rolls
-            WHERE chat_id=?
+            WHERE chat_id=? AND day<?
             ORDER BY day DESC
-            LIMIT 12
+            LIMIT ?
             """,
-            (chat_id,),
+            (chat_id, before or "9999-12-31", HISTORY_PAGE + 1),
+        ).fetchall()
+        has_older = len(rows) > HISTORY_PAGE
+        rows = rows[:HISTORY_PAGE]
+        has_newer = bool(rows) and before is not None and conn.execute(
+            "SELECT 1 FROM rolls WHERE chat_id=? AND day>? LIMIT 1",
+            (chat_id, rows[0][0]),
+        ).fetchone() is not None
+        return rows, has_older, has_newer
+
+def history_month_summaries(chat_id: int, first_day: str, last_day: str):
+    """Souhrny měsíců, kterých se stránka dotýká (rozsah po indexu (chat_id, day))."""
+    with db() as conn:
+        return conn.execute(
+            """
+            SELECT substr(day, 1, 7) as m,
+                   COUNT(*),
+                   SUM(CASE WHEN verdict='OBSTÁL' THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN verdict='UHNUL' THEN 1 ELSE 0 END)
+            FROM rolls
+            WHERE chat_id=? AND day>=? AND day<=?
+            GROUP BY m
+            ORDER BY m DESC
+            """,
+            (chat_id, first_day[:7] + "-01", last_day[:7] + "-31"),
         ).fetchall()
 
 # ============================================================
@@ -422,6 +1094,784 @@ def stats_streaks(chat_id: int):
 
     return streak_obstal, streak_bez_uhnul
 
+# ============================================================
+# DAILY ROLLUP
+# ============================================================
+GLOBAL_CHAT_ID = 0
+
+# Dny >= (dnes - ROLLUP_OPEN_DAYS) ještě nemusí být uzavřené ve všech zónách,
+# proto se neagregují a /stat N je dopočítá živě z rolls.
+ROLLUP_OPEN_DAYS = 1
+
+def _empty_agg() -> dict:
+    return {"rolls": 0, "obstal": 0, "uhnul": 0, "uhnul_planes": {}, "modes": {}}
+
+def _agg_add_roll(agg: dict, plane: str, mode: str, verdict: str | None):
+    agg["rolls"] += 1
+    if verdict is None:
+        return
+    ok = 1 if verdict == "OBSTÁL" else 0
+    if ok:
+        agg["obstal"] += 1
+    elif verdict == "UHNUL":
+        agg["uhnul"] += 1
+        agg["uhnul_planes"][plane] = agg["uhnul_planes"].get(plane, 0) + 1
+    m = agg["modes"].setdefault(mode, [0, 0])
+    m[0] += ok
+    m[1] += 1
+
+def _agg_merge(agg: dict, other: dict):
+    agg["rolls"] += other["rolls"]
+    agg["obstal"] += other["obstal"]
+    agg["uhnul"] += other["uhnul"]
+    for plane, c in other["uhnul_planes"].items():
+        agg["uhnul_planes"][plane] = agg["uhnul_planes"].get(plane, 0) + c
+    for mode, (ok, n) in other["modes"].items():
+        m = agg["modes"].setdefault(mode, [0, 0])
+        m[0] += ok
+        m[1] += n
+
+def _aggregate_rolls(rows) -> dict[int, dict]:
+    """rows: (chat_id, plane, mode, verdict) -> {chat_id: agg, GLOBAL_CHAT_ID: agg}"""
+    out = {GLOBAL_CHAT_ID: _empty_agg()}
+    for chat_id, plane, mode, verdict in rows:
+        user_agg = out.get(chat_id)
+        if user_agg is None:
+            user_agg = out[chat_id] = _empty_agg()
+        _agg_add_roll(user_agg, plane, mode, verdict)
+        _agg_add_roll(out[GLOBAL_CHAT_ID], plane, mode, verdict)
+    return out
+
+def _meta_get(conn: sqlite3.Connection, key: str) -> str | None:
+    row = conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+def _meta_set(conn: sqlite3.Connection, key: str, value: str):
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, value),
+    )
+
+def rollup_day(conn: sqlite3.Connection, day: str):
+    rows = conn.execute(
+        "SELECT chat_id, plane, COALESCE(scenario_mode, mode), verdict FROM rolls WHERE day=?",
+        (day,),
+    ).fetchall()
+    aggs = _aggregate_rolls(rows)
+
+    # DELETE + INSERT => opakované spuštění pro stejný den dá stejný výsledek
+    conn.execute("DELETE FROM daily_stats WHERE day=?", (day,))
+    conn.executemany(
+        """
+        INSERT INTO daily_stats (chat_id, day, rolls, obstal, uhnul, uhnul_planes, modes)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (chat_id, day, a["rolls"], a["obstal"], a["uhnul"],
+             json.dumps(a["uhnul_planes"], ensure_ascii=False), json.dumps(a["modes"], ensure_ascii=False))
+            for chat_id, a in aggs.items()
+        ],
+    )
+
+def rollup_closed_before() -> str:
+    today = datetime.fromisoformat(today_str()).date()
+    return (today - timedelta(days=ROLLUP_OPEN_DAYS)).isoformat()
+
+def rollup_catch_up() -> int:
+    """Zagreguje všechny uzavřené dny od posledního rollupu (i zameškané během výpadku)."""
+    closed_before = rollup_closed_before()
+    done = 0
+    with db() as conn:
+        last = _meta_get(conn, "rollup_last_day")
+        if last is None:
+            first = conn.execute("SELECT MIN(day) FROM rolls").fetchone()[0]
+            if first is None:
+                return 0
+            day = datetime.fromisoformat(first).date()
+        else:
+            day = datetime.fromisoformat(last).date() + timedelta(days=1)
+
+    while day.isoformat() < closed_before:
+        with db() as conn:
+            rollup_day(conn, day.isoformat())
+            _meta_set(conn, "rollup_last_day", day.isoformat())
+        day += timedelta(days=1)
+        done += 1
+
+    if done:
+        log.info("rollup: %d day(s) aggregated, last=%s", done, (day - timedelta(days=1)).isoformat())
+    return done
+
+def stats_window(chat_id: int, days: int) -> dict:
+    """Agregace za posledních `days` dní: uzavřené dny z daily_stats, zbytek živě z rolls."""
+    today_key = today_str() if chat_id == GLOBAL_CHAT_ID else today_str(chat_id)
+    start = (datetime.fromisoformat(today_key).date() - timedelta(days=days - 1)).isoformat()
+    agg = _empty_agg()
+
+    with db() as conn:
+        last = _meta_get(conn, "rollup_last_day")
+        live_from = start
+        if last is not None and last >= start:
+            live_from = (datetime.fromisoformat(last).date() + timedelta(days=1)).isoformat()
+            for rolls, obstal, uhnul, planes_json, modes_json in conn.execute(
+                """
+                SELECT rolls, obstal, uhnul, uhnul_planes, modes
+                FROM daily_stats
+                WHERE chat_id=? AND day>=? AND day<=?
+                """,
+                (chat_id, start, last),
+            ):
+                _agg_merge(agg, {
+                    "rolls": rolls, "obstal": obstal, "uhnul": uhnul,
+                    "uhnul_planes": json.loads(planes_json), "modes": json.loads(modes_json),
+                })
+
+        if chat_id == GLOBAL_CHAT_ID:
+            rows = conn.execute(
+                "SELECT chat_id, plane, COALESCE(scenario_mode, mode), verdict FROM rolls WHERE day>=?",
+                (live_from,),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                """
+                SELECT chat_id, plane, COALESCE(scenario_mode, mode), verdict
+                FROM rolls
+                WHERE chat_id=? AND day>=?
+                """,
+                (chat_id, live_from),
+            ).fetchall()
+
+    _agg_merge(agg, _aggregate_rolls(rows).get(chat_id, _empty_agg()))
+    return agg
+
+async def rollup_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(rollup_catch_up)
+
+# ============================================================
+# OFFLINE ANALYTICS (numpy, mimo hlavní proces)
+# ============================================================
+# Snapshot: jeden .npy soubor na sloupec rolls, načítaný přes mmap.
+#   chat   int32  index do users.npy (chat_id)
+#   day    int32  dny od 1970-01-01 (lokální den uživatele)
+#   number int8   rovina 1..12
+#   mode   int8   index do MODES, -1 = neznámý
+#   verdict int8  0 = bez verdiktu, 1 = OBSTÁL, 2 = UHNUL
+#   vmin   int16  minuta dne verdiktu, -1 = neznámá
+ANALYTICS_CHUNK = 100_000
+ANALYTICS_COLUMNS = ("chat", "day", "number", "mode", "verdict", "vmin")
+WEEKDAYS = ["Po", "Út", "St", "Čt", "Pá", "So", "Ne"]
+
+def _sql_minute(col: str) -> str:
+    return (
+        f"CASE WHEN length({col}) >= 16 "
+        f"THEN CAST(substr({col}, 12, 2) AS INTEGER) * 60 + CAST(substr({col}, 15, 2) AS INTEGER) "
+        f"ELSE -1 END"
+    )
+
+def analytics_snapshot(db_path: str, out_dir: str) -> int:
+    """Zkopíruje rolls do sloupcového snapshotu v out_dir (atomicky přes dočasný adresář)."""
+    import numpy as np
+
+    mode_case = " ".join(f"WHEN '{m}' THEN {i}" for i, m in enumerate(MODES))
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+    try:
+        # COUNT i SELECT musí vidět stejný snapshot, jinak řádky vložené mezi nimi
+        # přetečou předalokovaná pole
+        conn.execute("BEGIN")
+        n = conn.execute("SELECT COUNT(*) FROM rolls").fetchone()[0]
+        chat_ids = np.empty(n, dtype=np.int64)
+        cols = {
+            "day": np.empty(n, dtype=np.int32),
+            "number": np.empty(n, dtype=np.int8),
+            "mode": np.empty(n, dtype=np.int8),
+            "verdict": np.empty(n, dtype=np.int8),
+            "vmin": np.empty(n, dtype=np.int16),
+        }
+        cur = conn.execute(f"""
+            SELECT chat_id,
+                   CAST(julianday(day) - 2440587.5 AS INTEGER),
+                   number,
+                   CASE COALESCE(scenario_mode, mode) {mode_case} ELSE -1 END,
+                   CASE verdict WHEN 'OBSTÁL' THEN 1 WHEN 'UHNUL' THEN 2 ELSE 0 END,
+                   {_sql_minute("verdict_at")}
+            FROM rolls
+        """)
+        i = 0
+        while i < n:
+            chunk = cur.fetchmany(min(ANALYTICS_CHUNK, n - i))
+            if not chunk:
+                break
+            block = np.array(chunk, dtype=np.int64)
+            j = i + len(block)
+            chat_ids[i:j] = block[:, 0]
+            for k, name in enumerate(("day", "number", "mode", "verdict", "vmin"), start=1):
+                cols[name][i:j] = block[:, k]
+            i = j
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    users, chat_idx = np.unique(chat_ids[:i], return_inverse=True)
+    cols = {name: arr[:i] for name, arr in cols.items()}
+    cols["chat"] = chat_idx.astype(np.int32)
+    cols["users"] = users
+
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".analytics-", dir=parent)
+    for name, arr in cols.items():
+        np.save(os.path.join(tmp, f"{name}.npy"), arr)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp, out_dir)
+    return i
+
+def analytics_load(snap_dir: str) -> dict:
+    import numpy as np
+
+    return {
+        name: np.load(os.path.join(snap_dir, f"{name}.npy"), mmap_mode="r")
+        for name in ANALYTICS_COLUMNS + ("users",)
+    }
+
+def analytics_retention(snap: dict, weeks: int = 8, cohorts: int = 8):
+    """Kohorty podle týdne prvního hodu: podíl uživatelů aktivních v týdnu 0..weeks-1."""
+    import numpy as np
+
+    chat, day = snap["chat"], snap["day"]
+    n_users = len(snap["users"])
+    first = np.full(n_users, np.iinfo(np.int32).max, dtype=np.int32)
+    np.minimum.at(first, chat, day)
+
+    offset = (day - first[chat]) // 7
+    keep = offset < weeks
+    # každý (uživatel, týden) započítat jen jednou
+    active = np.unique(chat[keep].astype(np.int64) * weeks + offset[keep])
+    a_chat, a_off = active // weeks, active % weeks
+
+    # kalendářní týdny od pondělí jako v analytics_weekdays (den 0 = čtvrtek 1970-01-01)
+    cohort_week = (first + 3) // 7
+    c0 = cohort_week.max() - cohorts + 1 if n_users else 0
+    c_rel = cohort_week[a_chat] - c0
+    ok = c_rel >= 0
+    matrix = np.bincount(c_rel[ok] * weeks + a_off[ok], minlength=cohorts * weeks).reshape(cohorts, weeks)
+    sizes = matrix[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = np.where(sizes[:, None] > 0, matrix / sizes[:, None], 0.0)
+    starts = (np.arange(cohorts) + c0) * 7 - 3
+    return starts, sizes, rates
+
+def analytics_plane_mode(snap: dict):
+    """Úspěšnost rovina × režim (jen hody s verdiktem): (ok, n) matice 12 × len(MODES)."""
+    import numpy as np
+
+    v, m = snap["verdict"], snap["mode"]
+    sel = (v > 0) & (m >= 0)
+    key = (snap["number"][sel].astype(np.int64) - 1) * len(MODES) + m[sel]
+    size = 12 * len(MODES)
+    n = np.bincount(key, minlength=size).reshape(12, len(MODES))
+    ok = np.bincount(key, weights=(v[sel] == 1), minlength=size).reshape(12, len(MODES))
+    return ok.astype(np.int64), n
+
+def analytics_verdict_hours(snap: dict):
+    import numpy as np
+
+    vmin = snap["vmin"]
+    return np.bincount(vmin[vmin >= 0] // 60, minlength=24)
+
+def analytics_weekdays(snap: dict):
+    """Hody a úspěšnost podle dne v týdnu (Po=0)."""
+    import numpy as np
+
+    wd = (snap["day"] + 3) % 7  # 1970-01-01 byl čtvrtek
+    v = snap["verdict"]
+    rolls = np.bincount(wd, minlength=7)
+    judged = np.bincount(wd, weights=(v > 0), minlength=7)
+    ok = np.bincount(wd, weights=(v == 1), minlength=7)
+    return rolls, judged.astype(np.int64), ok.astype(np.int64)
+
+def analytics_report(snap: dict) -> str:
+    lines = [f"Hody: {len(snap['day'])}  Uživatelé: {len(snap['users'])}", ""]
+
+    starts, sizes, rates = analytics_retention(snap)
+    lines.append("Retence (kohorta = týden 1. hodu, % aktivních v týdnu 0..7)")
+    for start, size, row in zip(starts, sizes, rates):
+        if size:
+            day = (datetime(1970, 1, 1) + timedelta(days=int(start))).date().isoformat()
+            lines.append(f"{day} n={int(size):<5} " + " ".join(f"{r * 100:3.0f}" for r in row))
+    lines.append("")
+
+    ok, n = analytics_plane_mode(snap)
+    lines.append("Úspěšnost rovina × režim (%) " + " / ".join(m[:4] for m in MODES))
+    for i in range(12):
+        cells = [f"{ok[i, j] / n[i, j] * 100:3.0f}" if n[i, j] else "  —" for j in range(len(MODES))]
+        lines.append(f"{i + 1:>2} {PLANES[i + 1]:<12} " + "  ".join(cells))
+    lines.append("")
+
+    hours = analytics_verdict_hours(snap)
+    total = int(hours.sum())
+    lines.append("Čas verdiktu (hodina: %)")
+    if total:
+        lines.append(" ".join(f"{hh}:{c / total * 100:.0f}" for hh, c in enumerate(hours) if c))
+    else:
+        lines.append("—")
+    lines.append("")
+
+    rolls, judged, ok_wd = analytics_weekdays(snap)
+    lines.append("Den v týdnu: hody / úspěšnost")
+    for i, name in enumerate(WEEKDAYS):
+        rate = f"{ok_wd[i] / judged[i] * 100:.0f} %" if judged[i] else "—"
+        lines.append(f"{name} {int(rolls[i]):>7}  {rate}")
+    return "\n".join(lines)
+
+def run_analytics(db_path: str, out_dir: str) -> str:
+    """Vstupní bod pro worker proces: snapshot + report."""
+    t0 = perf_counter()
+    n = analytics_snapshot(db_path, out_dir)
+    t1 = perf_counter()
+    report = analytics_report(analytics_load(out_dir))
+    t2 = perf_counter()
+    return report + f"\n\nsnapshot {n} řádků: {t1 - t0:.1f}s, výpočet: {t2 - t1:.1f}s"
+
+_analytics_pool: ProcessPoolExecutor | None = None
+
+def analytics_pool() -> ProcessPoolExecutor:
+    global _analytics_pool
+    if _analytics_pool is None:
+        # spawn: žádný fork běžícího event loopu ani DB spojení
+        _analytics_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return _analytics_pool
+
+# ============================================================
+# DELIVERY (klasifikace chyb odeslání)
+# ============================================================
+DELIVERY_RETRIES = 3
+
+# BadRequest texty, které znamenají, že chat už neexistuje
+_GONE_MARKERS = ("chat not found", "user not found", "peer_id_invalid", "user is deactivated")
+
+DELIVERY_STATS = {"sent": 0, "permanent": 0, "transient": 0, "retried_ok": 0, "gave_up": 0, "reclaimed": 0}
+_transient_failures: dict[int, int] = {}
+
+def classify_send_error(e: BaseException) -> str | None:
+    """'permanent' = chat je nedosažitelný, 'transient' = zkusit znovu, None = chyba na naší straně."""
+    if isinstance(e, Forbidden):
+        return "permanent"
+    if isinstance(e, BadRequest):
+        msg = str(e).lower()
+        return "permanent" if any(m in msg for m in _GONE_MARKERS) else None
+    if isinstance(e, (RetryAfter, NetworkError)):
+        return "transient"
+    return None
+
+async def prune_unreachable(ctx, chat_id: int, e: BaseException):
+    """Vypne uživatele a zruší jeho připomínky; znovu se zapne přes /start."""
+    u = get_user(chat_id)
+    if u and int(u[4]) == 1:
+        set_user_enabled(chat_id, False, reason="unreachable")
+        DELIVERY_STATS["reclaimed"] += 1
+        log.info("delivery: chat %s unreachable (%s), disabled", chat_id, e)
+    _transient_failures.pop(chat_id, None)
+    await unschedule_user_jobs(ctx, chat_id)
+
+def _retry_after_s(e: BaseException) -> float | None:
+    delay = getattr(e, "retry_after", None)
+    if isinstance(delay, timedelta):
+        delay = delay.total_seconds()
+    return float(delay) if delay else None
+
+async def deliver_once(ctx, chat_id: int, **kwargs) -> tuple[str, float | None, BaseException | None]:
+    """Jeden pokus o send_message bez čekání: (výsledek, retry_after, chyba).
+
+    Výsledek je 'sent', 'permanent' (chat pročištěn) nebo 'transient'; ostatní chyby propadnou.
+    """
+    try:
+        await ctx.bot.send_message(chat_id=chat_id, **kwargs)
+    except TelegramError as e:
+        kind = classify_send_error(e)
+        if kind == "permanent":
+            DELIVERY_STATS["permanent"] += 1
+            await prune_unreachable(ctx, chat_id, e)
+            return "permanent", None, e
+        if kind != "transient":
+            raise
+        DELIVERY_STATS["transient"] += 1
+        _transient_failures[chat_id] = _transient_failures.get(chat_id, 0) + 1
+        return "transient", _retry_after_s(e), e
+
+    DELIVERY_STATS["sent"] += 1
+    _transient_failures.pop(chat_id, None)
+    return "sent", None, None
+
+async def deliver(ctx, chat_id: int, **kwargs) -> bool:
+    """send_message s retry pro dočasné chyby a pročištěním nedosažitelných chatů.
+
+    `ctx` je CallbackContext nebo Application (obojí má .bot a .job_queue).
+    """
+    for attempt in range(DELIVERY_RETRIES):
+        kind, retry_after, e = await deliver_once(ctx, chat_id, **kwargs)
+        if kind == "sent":
+            if attempt:
+                DELIVERY_STATS["retried_ok"] += 1
+            return True
+        if kind == "permanent":
+            return False
+        if attempt == DELIVERY_RETRIES - 1:
+            DELIVERY_STATS["gave_up"] += 1
+            log.warning("delivery: chat %s gave up after %d attempts: %s", chat_id, DELIVERY_RETRIES, e)
+            return False
+        await asyncio.sleep(retry_after or 2 ** attempt)
+    return False
+
+def delivery_snapshot() -> dict:
+    out = dict(DELIVERY_STATS)
+    out["chats_with_transient_failures"] = len(_transient_failures)
+    return out
+
+METRICS["delivery"] = delivery_snapshot
+
+# ============================================================
+# OUTBOX
+# ============================================================
+def outbox_message(text: str, parse_mode: str | None = None, reply_markup: InlineKeyboardMarkup | None = None) -> dict:
+    payload = {"text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.to_dict()
+    return payload
+
+def outbox_add(conn: sqlite3.Connection, chat_id: int, idem_key: str, payload: dict):
+    """Zařadí zprávu v rámci transakce volajícího; stejný idem_key se zařadí jen jednou."""
+    now = unix_time()
+    conn.execute(
+        """
+        INSERT INTO outbox (chat_id, idem_key, payload, created_at, next_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(idem_key) DO NOTHING
+        """,
+        (chat_id, idem_key, json.dumps(payload, ensure_ascii=False), now, now),
+    )
+
+def outbox_enqueue(chat_id: int, outbox: list[tuple[str, dict]]):
+    """Zařadí samostatné odpovědi (bez změny stavu), aby nepředběhly dříve zařazené zprávy."""
+    with db() as conn:
+        for idem_key, payload in outbox:
+            outbox_add(conn, chat_id, idem_key, payload)
+    outbox_notify()
+
+def outbox_due(limit: int, shard: tuple[int, int] | None = None, exclude=()):
+    """Zprávy k odeslání; chat se starší zprávou v backoffu se přeskočí celý (drží pořadí).
+
+    shard = (index, n): jen chaty workeru index, stejně jako shard_for() (modulo vždy nezáporné).
+    exclude = chaty, které sender právě odesílá.
+    """
+    now = unix_time()
+    params: list = [now, now]
+    shard_sql = ""
+    if shard is not None:
+        index, n = shard
+        shard_sql = "AND ((chat_id % ?) + ?) % ? = ?"
+        params += [n, n, n, index]
+    exclude = list(exclude)
+    if exclude:
+        shard_sql += f" AND chat_id NOT IN ({','.join('?' * len(exclude))})"
+        params += exclude
+    with db() as conn:
+        return conn.execute(
+            f"""
+            SELECT id, chat_id, payload, attempts
+            FROM outbox o
+            WHERE status='pending' AND next_at<=?
+              AND NOT EXISTS (
+                  SELECT 1 FROM outbox w
+                  WHERE w.status='pending' AND w.next_at>? AND w.chat_id=o.chat_id AND w.id<o.id
+              )
+              {shard_sql}
+            ORDER BY id
+            LIMIT ?
+            """,
+            (*params, limit),
+        ).fetchall()
+
+def outbox_mark_sent(outbox_id: int):
+    with db() as conn:
+        conn.execute("UPDATE outbox SET status='sent', sent_at=? WHERE id=?", (unix_time(), outbox_id))
+
+def outbox_mark_failed(outbox_id: int, attempts: int, error: str, dead: bool, delay: float | None = None):
+    """Další pokus za `delay` (retry_after od Telegramu), jinak exponenciální backoff."""
+    if delay is None:
+        delay = min(300, 2 ** attempts)
+    with db() as conn:
+        conn.execute(
+            """
+            UPDATE outbox
+            SET status=?, attempts=?, last_error=?, next_at=?
+            WHERE id=?
+            """,
+            ("dead" if dead else "pending", attempts, error[:500], unix_time() + delay, outbox_id),
+        )
+
+def outbox_purge_sent():
+    with db() as conn:
+        conn.execute(
+            "DELETE FROM outbox WHERE status='sent' AND sent_at<?",
+            (unix_time() - OUTBOX_KEEP_SENT_S,),
+        )
+
+def outbox_snapshot() -> dict:
+    with db() as conn:
+        depth, oldest = conn.execute(
+            "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE status='pending'"
+        ).fetchone()
+        dead = conn.execute("SELECT COUNT(*) FROM outbox WHERE status='dead'").fetchone()[0]
+    return {
+        "depth": depth,
+        "oldest_age_s": round(unix_time() - oldest, 1) if oldest else 0.0,
+        "dead": dead,
+    }
+
+METRICS["outbox"] = outbox_snapshot
+
+_outbox_wakeup: asyncio.Event | None = None
+_outbox_task: asyncio.Task | None = None
+
+def outbox_notify():
+    """Probudí sender hned po commitu (jinak by čekal až OUTBOX_POLL)."""
+    if _outbox_wakeup is not None:
+        _outbox_wakeup.set()
+
+async def _outbox_send(app, outbox_id: int, chat_id: int, payload_json: str, attempts: int) -> bool:
+    """Jeden pokus na jeden řádek; čekání na další pokus je next_at, ne sleep v senderu."""
+    payload = json.loads(payload_json)
+    if "reply_markup" in payload:
+        payload["reply_markup"] = InlineKeyboardMarkup.de_json(payload["reply_markup"], app.bot)
+    try:
+        kind, retry_after, e = await deliver_once(app, chat_id, **payload)
+    except TelegramError as err:
+        kind, retry_after, e = "error", None, err
+
+    if kind == "sent":
+        outbox_mark_sent(outbox_id)
+        return True
+    dead = kind == "permanent" or attempts + 1 >= OUTBOX_MAX_ATTEMPTS
+    outbox_mark_failed(outbox_id, attempts + 1, str(e), dead=dead, delay=retry_after)
+    return False
+
+async def outbox_sender(app, shard: tuple[int, int] | None = None):
+    """Odesílá outbox: v rámci chatu podle pořadí zařazení, každý chat ve vlastní úloze.
+
+    Pomalý chat nezdrží ostatní: smyčka nečeká na dokončení dávky, jen nepustí druhou
+    úlohu pro chat, který se zrovna odesílá. Souběžně max. OUTBOX_BATCH chatů.
+    Při WORKERS > 1 běží v každém workeru a bere jen chaty svého shardu,
+    takže outbox_notify() probudí právě ten sender, který zprávu odešle.
+    """
+    global _outbox_wakeup
+    _outbox_wakeup = asyncio.Event()
+    wakeup = _outbox_wakeup
+    inflight: dict[int, asyncio.Task] = {}
+    last_purge = 0.0
+
+    async def run_chat(chat_rows):
+        # po selhání zbytek chatu čeká: další zprávy nesmí předběhnout tu v backoffu
+        for outbox_id, chat_id, payload_json, attempts in chat_rows:
+            if not await _outbox_send(app, outbox_id, chat_id, payload_json, attempts):
+                break
+
+    def chat_done(chat_id: int, task: asyncio.Task):
+        inflight.pop(chat_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("outbox: chat %s send failed", chat_id, exc_info=task.exception())
+        wakeup.set()
+
+    try:
+        while True:
+            wakeup.clear()
+            rows = []
+            try:
+                free = OUTBOX_BATCH - len(inflight)
+                if free > 0:
+                    rows = outbox_due(OUTBOX_BATCH, shard, exclude=inflight.keys())
+                    per_chat: dict[int, list] = {}
+                    for row in rows:
+                        per_chat.setdefault(row[1], []).append(row)
+                    for chat_id, chat_rows in list(per_chat.items())[:free]:
+                        task = asyncio.create_task(run_chat(chat_rows))
+                        inflight[chat_id] = task
+                        task.add_done_callback(functools.partial(chat_done, chat_id))
+
+                if (shard is None or shard[0] == 0) and unix_time() - last_purge > 3600:
+                    outbox_purge_sent()
+                    last_purge = unix_time()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("outbox: sender iteration failed")
+
+            if len(rows) >= OUTBOX_BATCH and len(inflight) < OUTBOX_BATCH:
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=OUTBOX_POLL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for task in inflight.values():
+            task.cancel()
+
+def start_outbox_sender(app, shard: tuple[int, int] | None = None):
+    global _outbox_task
+    if _outbox_task is None or _outbox_task.done():
+        _outbox_task = asyncio.create_task(outbox_sender(app, shard))
+
+# ============================================================
+# BROADCAST
+# ============================================================
+def broadcast_create(text: str) -> int:
+    with db() as conn:
+        total = conn.execute("SELECT COUNT(*) FROM users WHERE is_enabled=1").fetchone()[0]
+        cur = conn.execute(
+            "INSERT INTO broadcasts (text, total, created_at) VALUES (?, ?, ?)",
+            (text, total, now_iso()),
+        )
+        return cur.lastrowid
+
+def broadcast_get(job_id: int | None = None):
+    with db() as conn:
+        if job_id is None:
+            return conn.execute(
+                """
+                SELECT id, text, status, cursor, total, sent, failed, active_s, created_at, finished_at
+                FROM broadcasts ORDER BY id DESC LIMIT 1
+                """
+            ).fetchone()
+        return conn.execute(
+            """
+            SELECT id, text, status, cursor, total, sent, failed, active_s, created_at, finished_at
+            FROM broadcasts WHERE id=?
+            """,
+            (job_id,),
+        ).fetchone()
+
+def broadcast_running_ids() -> list[int]:
+    with db() as conn:
+        return [r[0] for r in conn.execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")]
+
+def broadcast_next_batch(cursor: int, limit: int) -> list[int]:
+    with db() as conn:
+        rows = conn.execute(
+            """
+            SELECT chat_id FROM users
+            WHERE is_enabled=1 AND chat_id > ?
+            ORDER BY chat_id
+            LIMIT ?
+            """,
+            (cursor, limit),
+        ).fetchall()
+    return [r[0] for r in rows]
+
+def broadcast_checkpoint(job_id: int, cursor: int, sent: int, failed: int, active_s: float):
+    with db() as conn:
+        conn.execute(
+            """
+            UPDATE broadcasts
+            SET cursor=?, sent=sent+?, failed=failed+?, active_s=active_s+?
+            WHERE id=? AND status='running'
+            """,
+            (cursor, sent, failed, active_s, job_id),
+        )
+
+def broadcast_finish(job_id: int, status: str):
+    with db() as conn:
+        conn.execute(
+            "UPDATE broadcasts SET status=?, finished_at=? WHERE id=? AND status='running'",
+            (status, now_iso(), job_id),
+        )
+
+class RatePacer:
+    """Rovnoměrné rozložení odeslání na `rate` zpráv za sekundu."""
+
+    def __init__(self, rate: float):
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = perf_counter()
+
+    async def wait(self):
+        now = perf_counter()
+        if self._next > now:
+            delay = self._next - now
+            self._next += self._interval
+            await asyncio.sleep(delay)
+        else:
+            self._next = now + self._interval
+
+async def _broadcast_send(app, sem: asyncio.Semaphore, chat_id: int, text: str) -> bool:
+    async with sem:
+        try:
+            return await deliver(app, chat_id, text=text)
+        except TelegramError as e:
+            log.warning("broadcast: chat %s failed: %s", chat_id, e)
+            return False
+
+_broadcast_tasks: dict[int, asyncio.Task] = {}
+
+async def run_broadcast(app, job_id: int):
+    """Doručí broadcast od posledního checkpointu; po pádu se naváže (max. jedna dávka znovu)."""
+    job = broadcast_get(job_id)
+    if not job or job[2] != "running":
+        return
+    text, cursor = job[1], job[3]
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    pacer = RatePacer(BROADCAST_RATE)
+
+    while True:
+        job = broadcast_get(job_id)
+        if not job or job[2] != "running":
+            log.info("broadcast %s: stopped (%s)", job_id, job[2] if job else "missing")
+            return
+
+        batch = broadcast_next_batch(cursor, BROADCAST_BATCH)
+        if not batch:
+            broadcast_finish(job_id, "done")
+            job = broadcast_get(job_id)
+            log.info("broadcast %s: done, sent=%s failed=%s", job_id, job[5], job[6])
+            return
+
+        t0 = perf_counter()
+        tasks = []
+        for chat_id in batch:
+            await pacer.wait()
+            tasks.append(asyncio.create_task(_broadcast_send(app, sem, chat_id, text)))
+        results = await asyncio.gather(*tasks)
+
+        cursor = batch[-1]
+        sent = sum(1 for ok in results if ok)
+        broadcast_checkpoint(job_id, cursor, sent, len(results) - sent, perf_counter() - t0)
+
+def start_broadcast_task(app: Application, job_id: int):
+    task = _broadcast_tasks.get(job_id)
+    if task is not None and not task.done():
+        return
+    # asyncio.create_task, ne app.create_task: Application.stop() by na takové úlohy
+    # čekal a SIGTERM by visel až do konce broadcastu; ten se po startu obnoví z cursoru
+    _broadcast_tasks[job_id] = asyncio.create_task(run_broadcast(app, job_id))
+
+async def stop_broadcast_tasks(app: Application):
+    """post_stop: zruší rozjeté broadcasty (stav zůstává 'running', cursor je v DB)."""
+    tasks = [t for t in _broadcast_tasks.values() if not t.done()]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def format_broadcast_status(job) -> str:
+    job_id, _text, status, _cursor, total, sent, failed, active_s, created_at, finished_at = job
+    done = sent + failed
+    rate = (done / active_s) if active_s else 0.0
+    pct = (done / total * 100.0) if total else 100.0
+    return (
+        f"<b>Broadcast #{job_id}</b> — {h(status)}\n"
+        f"Odesláno: <b>{sent}</b>, chyby: {failed}, celkem: {total} ({pct:.0f} %)\n"
+        f"Propustnost: {rate:.1f} zpráv/s\n"
+        f"Založeno: {h(created_at)}" + (f"\nDokončeno: {h(finished_at)}" if finished_at else "")
+    )
+
 # ============================================================
 # CORE (random roll)
 # ============================================================
@@ -446,9 +1896,10 @@ def start_text() -> str:
         "• /hod — denní hod (1× denně)\n"
         "• /dnes — ukáže dnešní stav\n"
         "• /rezim — změní výchozí tón / uzamkne dnešek (když čeká)\n"
-        "• /historie — posledních 12 dní\n"
-        "• /stat — statistika\n"
+        "• /historie — historie (listování ‹ ›)\n"
+        "• /stat — statistika (/stat 30 — posledních 30 dní)\n"
         "• /cas 07:00 21:00 — rytmus dne\n"
+        "• /zona Europe/Prague — časové pásmo\n"
         "• /stop — zastaví připomínky\n\n"
         "Nevybíráš si rovinu.\n"
         "Pouze ji přijmeš — nebo uhneš."
@@ -482,6 +1933,17 @@ def msg_times_help() -> str:
 def msg_times_set(morning: str, evening: str) -> str:
     return f"Nastaveno.\nRáno: {morning}\nVečer: {evening}"
 
+def msg_tz_help(current: str) -> str:
+    return (
+        f"Časové pásmo: {current}\n\n"
+        "Změň ho:\n"
+        "/zona Europe/London\n\n"
+        "Den i připomínky se pak řídí tvou půlnocí."
+    )
+
+def msg_tz_set(tz_name: str) -> str:
+    return f"Nastaveno.\nČasové pásmo: {tz_name}"
+
 def copy_morning(default_mode: str) -> str:
     return (
         "<b>Dnes nezačínej myšlením.</b>\n\n"
@@ -533,6 +1995,38 @@ def action_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("VERDIKT", callback_data="verdict")],
     ])
 
+def verdict_dot(v) -> str:
+    if v == "OBSTÁL":
+        return "●"
+    if v == "UHNUL":
+        return "○"
+    return "·"
+
+def format_history(rows, months) -> str:
+    lines = [f"Historie {rows[-1][0]} – {rows[0][0]}:\n"]
+    for d, num, plane, verdict in rows:
+        lines.append(f"{verdict_dot(verdict)}  {d} — {num} {plane}")
+    lines.append("")
+    for month, n, ok, uhnul in months:
+        rate = f" ({ok / (ok + uhnul) * 100:.0f} %)" if (ok + uhnul) else ""
+        lines.append(f"{month}: {n}× · ● {ok} · ○ {uhnul}{rate}")
+    return "\n".join(lines)
+
+def history_keyboard(rows, has_older: bool, has_newer: bool) -> InlineKeyboardMarkup | None:
+    buttons = []
+    if has_older:
+        buttons.append(InlineKeyboardButton("‹ starší", callback_data=f"hist:<:{rows[-1][0]}"))
+    if has_newer:
+        buttons.append(InlineKeyboardButton("novější ›", callback_data=f"hist:>:{rows[0][0]}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def render_history(chat_id: int, before: str | None = None, after: str | None = None):
+    rows, has_older, has_newer = history_page(chat_id, before=before, after=after)
+    if not rows:
+        return None, None
+    months = history_month_summaries(chat_id, rows[-1][0], rows[0][0])
+    return format_history(rows, months), history_keyboard(rows, has_older, has_newer)
+
 def valid_hhmm(s: str) -> bool:
     try:
         hh, mm = s.split(":")
@@ -576,6 +2070,7 @@ async def show_today_status(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     upsert_user(chat_id)
+    set_user_enabled(chat_id, True)
 
     await update.message.reply_text(start_text(), parse_mode=ParseMode.HTML)
 
@@ -636,22 +2131,11 @@ async def cmd_rezim(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_historie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    rows = last_12(chat_id)
-    if not rows:
+    text, kb = render_history(chat_id)
+    if text is None:
         await update.message.reply_text("Zatím žádná stopa.")
         return
-
-    def dot(v):
-        if v == "OBSTÁL":
-            return "●"
-        if v == "UHNUL":
-            return "○"
-        return "·"
-
-    lines = ["Posledních 12 dní:\n"]
-    for d, num, plane, verdict in rows:
-        lines.append(f"{dot(verdict)}  {d} — {num} {plane}")
-    await update.message.reply_text("\n".join(lines))
+    await update.message.reply_text(text, reply_markup=kb)
 
 async def cmd_cas(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -674,6 +2158,68 @@ async def cmd_cas(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await schedule_user_jobs(context, chat_id, force_reschedule=True)
     await update.message.reply_text(msg_times_set(morning, evening))
 
+async def cmd_zona(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    upsert_user(chat_id)
+
+    parts = (update.message.text or "").strip().split()
+    if len(parts) == 1:
+        await update.message.reply_text(msg_tz_help(user_tz(chat_id)))
+        return
+    if len(parts) != 2 or not valid_tz(parts[1]):
+        await update.message.reply_text("Neznámé pásmo. Použij např. /zona Europe/Prague.")
+        return
+
+    tz_name = parts[1]
+    set_user_timezone(chat_id, None if tz_name == TZ_NAME else tz_name)
+    await schedule_user_jobs(context, chat_id, force_reschedule=True)
+    await update.message.reply_text(msg_tz_set(tz_name))
+
+async def cmd_analytika(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    await update.message.reply_text("Analytika běží (snapshot + výpočet mimo bot)…")
+    loop = asyncio.get_running_loop()
+    try:
+        report = await loop.run_in_executor(analytics_pool(), run_analytics, DB_PATH, ANALYTICS_DIR)
+    except ImportError:
+        await update.message.reply_text("Analytika vyžaduje numpy (pip install numpy).")
+        return
+    await update.message.reply_text(f"<pre>{h(report)}</pre>", parse_mode=ParseMode.HTML)
+
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        return
+
+    parts = (update.message.text or "").split(maxsplit=1)
+    arg = parts[1].strip() if len(parts) > 1 else ""
+
+    if arg in ("", "status"):
+        job = broadcast_get()
+        if not job:
+            await update.message.reply_text("Použití:\n/broadcast <text>\n/broadcast status\n/broadcast cancel")
+            return
+        await update.message.reply_text(format_broadcast_status(job), parse_mode=ParseMode.HTML)
+        return
+
+    if arg == "cancel":
+        job = broadcast_get()
+        if not job or job[2] != "running":
+            await update.message.reply_text("Žádný běžící broadcast.")
+            return
+        broadcast_finish(job[0], "cancelled")
+        await update.message.reply_text(format_broadcast_status(broadcast_get(job[0])), parse_mode=ParseMode.HTML)
+        return
+
+    if broadcast_running_ids():
+        await update.message.reply_text("Broadcast už běží. /broadcast status | /broadcast cancel")
+        return
+
+    job_id = broadcast_create(arg)
+    start_broadcast_task(context.application, job_id)
+    await update.message.reply_text(format_broadcast_status(broadcast_get(job_id)), parse_mode=ParseMode.HTML)
+
 async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     upsert_user(chat_id)
@@ -681,10 +2227,62 @@ async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await unschedule_user_jobs(context, chat_id)
     await update.message.reply_text(msg_paused())
 
+STAT_MAX_WINDOW = 366
+
+def format_stat_window(agg: dict, days: int, is_global: bool) -> str:
+    ok_, uhnul = agg["obstal"], agg["uhnul"]
+    rate = (ok_ / (ok_ + uhnul) * 100.0) if (ok_ + uhnul) else 0.0
+    v_lines = [
+        f"• OBSTÁL: {ok_}",
+        f"• UHNUL: {uhnul}",
+        f"• BEZ VERDIKTU: {agg['rolls'] - ok_ - uhnul}",
+    ]
+    top = sorted(agg["uhnul_planes"].items(), key=lambda kv: kv[1], reverse=True)[:5]
+    t_lines = [f"• {plane}: {c}" for plane, c in top] or ["—"]
+
+    if not is_global:
+        return (
+            f"<b>/stat {days} — Tvoje stopa ({days} dní)</b>\n\n"
+            f"Záznamy: <b>{agg['rolls']}</b>\n\n"
+            "<b>Verdikty</b>\n" + "\n".join(v_lines) +
+            f"\n\nÚspěšnost (z verdiktů): <b>{rate:.0f} %</b>\n\n"
+            "<b>Kde nejčastěji uhýbáš</b>\n" + "\n".join(t_lines)
+        )
+
+    m_lines = []
+    for mode, (ok, n) in sorted(agg["modes"].items(), key=lambda kv: kv[1][1], reverse=True):
+        m_rate = (ok / n * 100.0) if n else 0.0
+        m_lines.append(f"• {mode}: {ok}/{n} ({m_rate:.0f} %)")
+    if not m_lines:
+        m_lines = ["—"]
+
+    return (
+        f"<b>/stat {days} — Globální přehled ({days} dní)</b>\n\n"
+        f"Záznamy: <b>{agg['rolls']}</b>\n"
+        f"Úspěšnost (z verdiktů): <b>{rate:.0f} %</b>\n\n"
+        "<b>Verdikty</b>\n" + "\n".join(v_lines) +
+        "\n\n<b>Nejčastější UHNUL (roviny)</b>\n" + "\n".join(t_lines) +
+        "\n\n<b>Úspěšnost podle režimu (jen tam, kde je verdikt)</b>\n" + "\n".join(m_lines)
+    )
+
 async def cmd_stat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     upsert_user(chat_id)
 
+    parts = (update.message.text or "").strip().split()
+    if len(parts) > 1:
+        if not parts[1].isdigit() or not 1 <= int(parts[1]) <= STAT_MAX_WINDOW:
+            await update.message.reply_text(f"Použití: /stat 7 | /stat 30 | /stat 90 (max {STAT_MAX_WINDOW}).")
+            return
+        days = int(parts[1])
+        target = GLOBAL_CHAT_ID if is_admin(update) else chat_id
+        agg = stats_window(target, days)
+        await update.message.reply_text(
+            format_stat_window(agg, days, target == GLOBAL_CHAT_ID),
+            parse_mode=ParseMode.HTML,
+        )
+        return
+
     if is_admin(update):
         users = stats_users_total()
         total = stats_counts_total(None)
@@ -702,9 +2300,12 @@ async def cmd_stat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not m_lines:
             m_lines = ["—"]
 
+        unreachable = stats_unreachable_total()
+
         text = (
             "<b>/stat — Globální přehled</b>\n\n"
             f"Uživatelé: <b>{users}</b>\n"
+            f"Nedosažitelní (vypnuto): <b>{unreachable}</b>\n"
             f"Záznamy: <b>{total}</b>\n\n"
             "<b>Verdikty</b>\n" + "\n".join(v_lines) +
             "\n\n<b>Nejčastější UHNUL (roviny)</b>\n" + "\n".join(t_lines) +
@@ -742,7 +2343,8 @@ async def cmd_stat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ============================================================
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    # answer() jen zhasne "hodiny" na tlačítku; na zápis do DB se čekat nemá
+    context.application.create_task(query.answer(), update=update)
     chat_id = query.message.chat.id
     data = (query.data or "").strip()
 
@@ -778,20 +2380,28 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("v:"):
         verdict = data.split(":", 1)[1]
+        # všechny odpovědi v:/pick: jdou přes outbox, jinak by předběhly dříve zařazené zprávy
         row = get_today_roll(chat_id)
         if not row:
-            await query.message.reply_text(msg_no_roll_yet(), parse_mode=ParseMode.HTML)
+            outbox_enqueue(chat_id, [
+                (f"cb:{query.id}", outbox_message(msg_no_roll_yet(), parse_mode=ParseMode.HTML)),
+            ])
             return
 
         _day, _number, _plane, mode_db, scenario_mode, pending, _verdict = row
         chosen_mode = scenario_mode or mode_db
 
         if int(pending) == 1 or not scenario_mode:
-            await query.message.reply_text("Nejdřív zvol tón pro dnešek.", reply_markup=mode_keyboard(prefix="pick:"))
+            outbox_enqueue(chat_id, [
+                (f"cb:{query.id}", outbox_message("Nejdřív zvol tón pro dnešek.", reply_markup=mode_keyboard(prefix="pick:"))),
+            ])
             return
 
-        set_verdict(chat_id, verdict)
-        await query.message.reply_text(verdict_reply(chosen_mode, verdict))
+        # stav i odpověď v jedné transakci; odešle ji outbox sender
+        set_verdict(chat_id, verdict, outbox=[
+            (f"cb:{query.id}", outbox_message(verdict_reply(chosen_mode, verdict))),
+        ])
+        outbox_notify()
         return
 
     if data.startswith("pick:"):
@@ -801,22 +2411,44 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         row = get_today_roll(chat_id)
         if not row:
-            await query.message.reply_text("Nejdřív hoď: /hod")
+            outbox_enqueue(chat_id, [(f"cb:{query.id}", outbox_message("Nejdřív hoď: /hod"))])
             return
 
         _day, number, _plane, _mode_db, scenario_mode, pending, _verdict = row
 
         if int(pending) == 0 and scenario_mode:
-            set_user_mode(chat_id, mode)
-            await query.message.reply_text(f"Dnešek už je uzamčený.\n{msg_mode_default_set(mode)}")
+            set_user_mode(chat_id, mode, outbox=[
+                (f"cb:{query.id}", outbox_message(f"Dnešek už je uzamčený.\n{msg_mode_default_set(mode)}")),
+            ])
+            outbox_notify()
             return
 
-        finalize_roll_mode(chat_id, mode)
-        set_user_mode(chat_id, mode)
-
         msg = format_scenario(mode, int(number))
-        await query.message.reply_text(f"Režim: {mode}")
-        await query.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=action_keyboard())
+        finalize_roll_mode(chat_id, mode, outbox=[
+            (f"cb:{query.id}:1", outbox_message(f"Režim: {mode}")),
+            (f"cb:{query.id}:2", outbox_message(msg, parse_mode=ParseMode.HTML, reply_markup=action_keyboard())),
+        ])
+        outbox_notify()
+        return
+
+    if data.startswith("hist:"):
+        _prefix, direction, day = (data.split(":", 2) + ["", ""])[:3]
+        if direction not in ("<", ">"):
+            return
+        text, kb = render_history(
+            chat_id,
+            before=day if direction == "<" else None,
+            after=day if direction == ">" else None,
+        )
+        if text is None:
+            await query.edit_message_reply_markup(reply_markup=None)
+            return
+        try:
+            await query.edit_message_text(text, reply_markup=kb)
+        except BadRequest as e:
+            # dvojklik na stejné tlačítko: stránka už je zobrazená
+            if "not modified" not in str(e).lower():
+                raise
         return
 
     if data.startswith("default:"):
@@ -867,8 +2499,9 @@ async def schedule_user_jobs(context: ContextTypes.DEFAULT_TYPE, chat_id: int, f
     morning_str = u[2] or MORNING_DEFAULT
     evening_str = u[3] or EVENING_DEFAULT
 
-    morning_t = time(int(morning_str.split(":")[0]), int(morning_str.split(":")[1]), tzinfo=TZ)
-    evening_t = time(int(evening_str.split(":")[0]), int(evening_str.split(":")[1]), tzinfo=TZ)
+    tz = DAY_KEYS.zone(u[5] or TZ_NAME)
+    morning_t = time(int(morning_str.split(":")[0]), int(morning_str.split(":")[1]), tzinfo=tz)
+    evening_t = time(int(evening_str.split(":")[0]), int(evening_str.split(":")[1]), tzinfo=tz)
 
     jname_m = f"morning:{chat_id}"
     jname_e = f"evening:{chat_id}"
@@ -887,70 +2520,482 @@ async def unschedule_user_jobs(context: ContextTypes.DEFAULT_TYPE, chat_id: int)
         if j.name in (f"morning:{chat_id}", f"evening:{chat_id}"):
             j.schedule_removal()
 
+def active_job_user(context: ContextTypes.DEFAULT_TYPE):
+    """Uživatel připomínky, nebo None. Vypnutý chat si job odplánuje sám: při WORKERS > 1
+    ho mohl vypnout jiný worker (broadcast, outbox) a ten k cizí job queue nemá přístup.
+    Opětovné zapnutí (/start) joby naplánuje znovu."""
+    u = get_user(context.job.chat_id)
+    if not u or int(u[4]) != 1:
+        context.job.schedule_removal()
+        return None
+    return u
+
 async def morning_job(context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.job.chat_id
-    u = get_user(chat_id)
-    if not u or int(u[4]) != 1:
+    u = active_job_user(context)
+    if u is None:
         return
     default_mode = u[1]
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("HOĎ", callback_data="roll_now")]])
-    await context.bot.send_message(chat_id=chat_id, text=copy_morning(default_mode), parse_mode=ParseMode.HTML, reply_markup=kb)
+    await deliver(context, chat_id, text=copy_morning(default_mode), parse_mode=ParseMode.HTML, reply_markup=kb)
 
 async def evening_job(context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.job.chat_id
-    u = get_user(chat_id)
-    if not u or int(u[4]) != 1:
+    if active_job_user(context) is None:
         return
 
     row = get_today_roll(chat_id)
     if not row:
-        await context.bot.send_message(chat_id=chat_id, text="Bez hodu není stopa.\nPoužij /hod.")
+        await deliver(context, chat_id, text="Bez hodu není stopa.\nPoužij /hod.")
         return
 
     _day, _number, _plane, mode_db, scenario_mode, pending, _verdict = row
     chosen_mode = scenario_mode or mode_db
 
     if int(pending) == 1 or not scenario_mode:
-        await context.bot.send_message(chat_id=chat_id, text="Dnes ještě chybí tón.\nZvol ho: /rezim")
+        await deliver(context, chat_id, text="Dnes ještě chybí tón.\nZvol ho: /rezim")
         return
 
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("OBSTÁL JSEM", callback_data="v:OBSTÁL")],
         [InlineKeyboardButton("UHNUL JSEM", callback_data="v:UHNUL")],
     ])
-    await context.bot.send_message(chat_id=chat_id, text=copy_evening(chosen_mode), reply_markup=kb)
+    await deliver(context, chat_id, text=copy_evening(chosen_mode), reply_markup=kb)
 
 # ============================================================
 # ERROR HANDLER
 # ============================================================
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    # odpověď do chatu, který bota zablokoval => vypnout, ne logovat traceback
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None and classify_send_error(context.error) == "permanent":
+        DELIVERY_STATS["permanent"] += 1
+        await prune_unreachable(context, chat.id, context.error)
+        return
     log.exception("Unhandled exception", exc_info=context.error)
 
+# ============================================================
+# BACKLOG CATCH-UP
+# ============================================================
+# Updaty se zpracovávají souběžně napříč chaty, v rámci chatu přesně v pořadí příchodu.
+# Prvních N updatů po startu (N = pending_update_count) je backlog z výpadku:
+#   - sousední idempotentní updaty téhož chatu se sloučí,
+#   - běží max. CATCHUP_CONCURRENCY najednou; živé updaty mají vlastní limit UPDATE_CONCURRENCY,
+#     takže na backlog nikdy nečekají.
+# Sloučení jen v rámci souvislého běhu stejného klíče:
+#   "last"  => čtení stavu, platí poslední (/dnes, /stat, opakované ťuknutí na verdikt)
+#   "first" => další výskyt nic nemění (hod, stejný pick: znovu)
+_KEEP_LAST_COMMANDS = ("/start", "/dnes", "/historie", "/stat", "/rezim")
+_KEEP_LAST_CALLBACKS = ("accept", "verdict")
+# PTB semafor by počítal i updaty čekající na pořadí v chatu; skutečné limity jsou
+# _live_sem a _backlog_sem (drží se jen po dobu běhu handleru)
+CATCHUP_MAX_INFLIGHT = 1_000_000
+
+def _update_chat_id(u) -> int | None:
+    chat = getattr(u, "effective_chat", None)
+    return chat.id if chat is not None else None
+
+def _coalesce_key(u) -> tuple[str, str] | None:
+    msg = getattr(u, "message", None)
+    if msg is not None and msg.text:
+        text = msg.text.strip()
+        cmd = text.split()[0].split("@")[0].lower()
+        if cmd == "/hod":
+            return ("first", "roll")
+        if cmd in _KEEP_LAST_COMMANDS:
+            return ("last", text)
+        return None
+
+    query = getattr(u, "callback_query", None)
+    if query is not None and query.data:
+        data = query.data.strip()
+        if data == "roll_now":
+            return ("first", "roll")
+        if data.startswith("v:"):
+            return ("last", "v:")
+        if data.startswith("pick:"):
+            # první pick uzamyká den => slučuje se jen opakování téže volby
+            return ("first", data)
+        if data in _KEEP_LAST_CALLBACKS:
+            return ("last", data)
+    return None
+
+def _superseded(key, prev_key, next_key) -> bool:
+    if key is None:
+        return False
+    if key[0] == "first":
+        return prev_key == key
+    return next_key == key
+
+class _ChatEntry:
+    __slots__ = ("key", "backlog", "done")
+
+    def __init__(self, key, backlog: bool):
+        self.key = key
+        self.backlog = backlog
+        self.done = asyncio.Event()
+
+class CatchUpProcessor(BaseUpdateProcessor):
+    """Pořadí v rámci chatu, chaty souběžně, backlog po výpadku sloučený a s nižší prioritou."""
+
+    def __init__(self):
+        super().__init__(max_concurrent_updates=CATCHUP_MAX_INFLIGHT)
+        self._chats: dict[int, deque] = {}
+        self._last_key: dict[int, tuple | None] = {}
+        self._live_sem: asyncio.Semaphore | None = None
+        self._backlog_sem: asyncio.Semaphore | None = None
+        self.backlog_left = 0
+        self.stats = {"backlog": 0, "processed": 0, "coalesced": 0, "drain_s": None}
+        self._backlog_t0 = 0.0
+
+    async def initialize(self) -> None:
+        self._live_sem = asyncio.Semaphore(UPDATE_CONCURRENCY)
+        self._backlog_sem = asyncio.Semaphore(CATCHUP_CONCURRENCY)
+
+    async def shutdown(self) -> None:
+        pass
+
+    def start_backlog(self, pending: int):
+        self.backlog_left = pending
+        self.stats.update(backlog=pending, processed=0, coalesced=0, drain_s=None)
+        self._backlog_t0 = perf_counter()
+
+    def _backlog_done(self, coalesced: bool):
+        self.stats["coalesced" if coalesced else "processed"] += 1
+        if self.stats["processed"] + self.stats["coalesced"] == self.stats["backlog"]:
+            self.stats["drain_s"] = round(perf_counter() - self._backlog_t0, 2)
+            log.info(
+                "catch-up: drained %(backlog)d updates (%(coalesced)d coalesced) in %(drain_s).1fs",
+                self.stats,
+            )
+
+    async def _run(self, coroutine, backlog: bool):
+        async with self._backlog_sem if backlog else self._live_sem:
+            await coroutine
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        backlog = self.backlog_left > 0
+        if backlog:
+            self.backlog_left -= 1
+
+        chat_id = _update_chat_id(update)
+        if chat_id is None:
+            try:
+                await self._run(coroutine, backlog)
+            finally:
+                if backlog:
+                    self._backlog_done(False)
+            return
+
+        entry = _ChatEntry(_coalesce_key(update) if backlog else None, backlog)
+        queue = self._chats.setdefault(chat_id, deque())
+        queue.append(entry)
+        started = dropped = False
+        try:
+            if backlog:
+                # dát šanci už stažené dávce zařadit se => soused pro slučování je vidět
+                await asyncio.sleep(0)
+            while queue[0] is not entry:
+                await queue[0].done.wait()
+
+            next_key = queue[1].key if len(queue) > 1 else None
+            dropped = _superseded(entry.key, self._last_key.get(chat_id), next_key)
+            started = True
+            if dropped:
+                coroutine.close()
+            else:
+                await self._run(coroutine, backlog)
+        finally:
+            if not started:
+                coroutine.close()
+            self._last_key[chat_id] = entry.key
+            queue.remove(entry)
+            entry.done.set()
+            if not queue:
+                del self._chats[chat_id]
+                self._last_key.pop(chat_id, None)
+            if backlog:
+                self._backlog_done(dropped)
+
+def catch_up_snapshot() -> dict:
+    return dict(_catch_up_stats)
+
+_catch_up_stats: dict = {}
+METRICS["catch_up"] = catch_up_snapshot
+
+async def start_catch_up(app: Application):
+    """Jeden dotaz na velikost backlogu; samotné updaty stáhne běžný polling."""
+    processor = app.update_processor
+    if not isinstance(processor, CatchUpProcessor):
+        return
+    global _catch_up_stats
+    _catch_up_stats = processor.stats
+    try:
+        info = await app.bot.get_webhook_info()
+    except TelegramError as e:
+        log.warning("catch-up: getWebhookInfo failed: %s", e)
+        return
+    pending = info.pending_update_count or 0
+    if pending >= CATCHUP_MIN_BACKLOG:
+        log.info("catch-up: %d pending updates", pending)
+        processor.start_backlog(pending)
+
+# ============================================================
+# SHARDED WORKERS (WORKERS > 1)
+# ============================================================
+# Front proces: getUpdates -> fronta workeru podle chat_id % N (pořadí v chatu zachováno).
+# Worker: Application bez updateru, updaty zpracovává sekvenčně ze své fronty.
+# DB: sdílená WAL databáze; zápisy jsou krátké autocommit/implicitní transakce a souběh
+# řeší zámek zapisovatele SQLite (busy timeout 30 s v db()).
+def shard_for(chat_id: int, n_workers: int) -> int:
+    return chat_id % n_workers
+
+def worker_main(index: int, q, n_workers: int):
+    """Vstupní bod worker procesu (spawn)."""
+    # Ctrl+C dostane celá skupina procesů; ukončení řídí front přes sentinel ve frontě
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_context.set({"worker": index})
+    asyncio.run(_worker_loop(index, q, n_workers))
+
+async def _worker_loop(index: int, q, n_workers: int):
+    app = build_application(polling=False)
+    loop = asyncio.get_running_loop()
+    async with app:
+        await app.start()
+        start_outbox_sender(app, shard=(index, n_workers))
+        if index == 0:
+            start_background_jobs(app)
+        log.info("worker %d: ready", index)
+        try:
+            while True:
+                raw = await loop.run_in_executor(None, q.get)
+                if raw is None:
+                    break
+                await app.process_update(Update.de_json(json.loads(raw), app.bot))
+        finally:
+            await stop_broadcast_tasks(app)
+            await app.stop()
+
+async def _put_to_worker(q, proc, raw: str):
+    """Vloží update do fronty workeru; blokující put běží mimo event loop a s timeoutem.
+
+    Mrtvý nebo zaseknutý worker shodí front (RuntimeError), platforma instanci restartuje;
+    nepotvrzený offset zajistí, že Telegram updaty pošle znovu.
+    """
+    try:
+        q.put_nowait(raw)
+        return
+    except queue.Full:
+        pass
+    loop = asyncio.get_running_loop()
+    t0 = perf_counter()
+    while True:
+        try:
+            await loop.run_in_executor(None, functools.partial(q.put, raw, timeout=WORKER_PUT_TIMEOUT))
+            return
+        except queue.Full:
+            if not proc.is_alive():
+                raise RuntimeError(f"{proc.name} exited with a full queue")
+            stalled = perf_counter() - t0
+            if stalled >= WORKER_STALL_S:
+                raise RuntimeError(f"{proc.name} stalled: queue full for {stalled:.0f}s")
+            log.warning("front: queue of %s full for %.0fs", proc.name, stalled)
+
+async def _front_loop(queues: list, procs: list):
+    bot = Bot(BOT_TOKEN, request=build_request(2), get_updates_request=build_request(TG_UPDATES_POOL_SIZE))
+    offset = None
+    # jako run_polling: SIGTERM/SIGINT ukončí smyčku a run_sharded pošle workerům sentinel
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    stop_wait = asyncio.create_task(stop.wait())
+    async with bot:
+        STARTUP.mark("bot_init")
+        log.info("%s | front polling for %d workers", STARTUP.report(), len(queues))
+        while not stop.is_set():
+            dead = [i for i, p in enumerate(procs) if not p.is_alive()]
+            if dead:
+                raise RuntimeError(f"worker(s) {dead} exited")
+            poll = asyncio.create_task(bot.get_updates(
+                offset=offset, timeout=TG_POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES,
+            ))
+            await asyncio.wait((poll, stop_wait), return_when=asyncio.FIRST_COMPLETED)
+            if not poll.done():
+                poll.cancel()
+                await asyncio.gather(poll, return_exceptions=True)
+                break
+            try:
+                updates = poll.result()
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                await asyncio.sleep(float(retry_after))
+                continue
+            except NetworkError as e:
+                log.warning("front: getUpdates failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+
+            for u in updates:
+                chat = u.effective_chat
+                key = chat.id if chat is not None else u.update_id
+                shard = shard_for(key, len(queues))
+                await _put_to_worker(queues[shard], procs[shard], u.to_json())
+                offset = u.update_id + 1
+        log.info("front: stop signal, shutting down workers")
+        if offset is not None:
+            # potvrdit už předané updaty, ať je Telegram po restartu nepošle znovu
+            try:
+                await bot.get_updates(offset=offset, timeout=0, allowed_updates=Update.ALL_TYPES)
+            except TelegramError as e:
+                log.warning("front: final offset ack failed: %s", e)
+    stop_wait.cancel()
+
+def run_sharded(n_workers: int):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(WORKER_QUEUE_SIZE) for _ in range(n_workers)]
+    # ne-daemon: worker si pro /analytika spouští vlastní ProcessPoolExecutor,
+    # daemon proces děti mít nesmí; ukončení řeší finally níže
+    procs = [ctx.Process(target=worker_main, args=(i, q, n_workers), name=f"worker-{i}")
+             for i, q in enumerate(queues)]
+    for p in procs:
+        p.start()
+    STARTUP.mark("workers_spawn")
+    try:
+        asyncio.run(_front_loop(queues, procs))
+    finally:
+        # put_nowait: fronta mrtvého workeru může být plná a put() by visel navždy
+        for q in queues:
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                pass
+        for p in procs:
+            p.join(timeout=10)
+            if p.is_alive():
+                log.warning("worker %s neskončil do 10 s, ukončuji", p.name)
+                p.terminate()
+                p.join(timeout=5)
+
 # ============================================================
 # MAIN
 # ============================================================
+_db_ready: Future | None = None
+_first_update_seen = False
+
+def _timed_init_db():
+    t0 = perf_counter()
+    init_db()
+    STARTUP.note("init_db", perf_counter() - t0)
+
+async def post_init(app: Application):
+    # initialize() (getMe) už proběhl; DB warm-up běžel souběžně ve vlákně
+    STARTUP.mark("bot_init")
+    if _db_ready is not None:
+        await asyncio.wrap_future(_db_ready)
+    STARTUP.mark("db_wait")
+    log.info("%s | ready to poll", STARTUP.report())
+
+    start_outbox_sender(app)
+    start_background_jobs(app)
+    await start_catch_up(app)
+
+def start_background_jobs(app: Application):
+    """Globální úlohy (rollup, rozjeté broadcasty); při více workerech jen ve workeru 0."""
+    if app.job_queue is not None:
+        # dohnání zameškaných dnů hned po startu, pak každou noc
+        app.job_queue.run_once(rollup_job, when=0, name="rollup:catch-up")
+        app.job_queue.run_daily(rollup_job, time=time(0, 30, tzinfo=TZ), name="rollup")
+
+    for job_id in broadcast_running_ids():
+        log.info("broadcast %s: resuming", job_id)
+        start_broadcast_task(app, job_id)
+
+async def set_log_context(update: object, context: ContextTypes.DEFAULT_TYPE):
+    ctx = {"update_id": getattr(update, "update_id", None)}
+    if "worker" in log_context.get():
+        ctx["worker"] = log_context.get()["worker"]
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        ctx["chat_id"] = chat.id
+    msg = getattr(update, "message", None)
+    query = getattr(update, "callback_query", None)
+    if msg is not None and msg.text and msg.text.startswith("/"):
+        ctx["command"] = msg.text.split()[0].split("@")[0]
+    elif query is not None and query.data:
+        ctx["command"] = "cb:" + query.data.split(":", 1)[0]
+    log_context.set(ctx)
+
+async def on_first_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    global _first_update_seen
+    if _first_update_seen:
+        return
+    _first_update_seen = True
+    STARTUP.mark("first_update")
+    log.info("%s | time-to-first-update %.0fms", STARTUP.report(), STARTUP.elapsed() * 1000)
+
+def build_application(polling: bool = True) -> Application:
+    builder = (
+        Application.builder()
+        .application_class(TracingApplication if TRACE_SLOW_MS > 0 else Application)
+        .token(BOT_TOKEN)
+        .request(build_request(TG_POOL_SIZE))
+    )
+    if polling:
+        builder = (
+            builder.get_updates_request(build_request(TG_UPDATES_POOL_SIZE))
+            .concurrent_updates(CatchUpProcessor())
+            .post_init(post_init)
+            .post_stop(stop_broadcast_tasks)
+        )
+    else:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(TypeHandler(Update, set_log_context), group=-2)
+    app.add_handler(TypeHandler(Update, on_first_update), group=-1)
+
+    app.add_handler(CommandHandler("start", traced(cmd_start)))
+    app.add_handler(CommandHandler("hod", traced(cmd_hod)))
+    app.add_handler(CommandHandler("dnes", traced(cmd_dnes)))
+    app.add_handler(CommandHandler("rezim", traced(cmd_rezim)))
+    app.add_handler(CommandHandler("historie", traced(cmd_historie)))
+    app.add_handler(CommandHandler("stat", traced(cmd_stat)))
+    app.add_handler(CommandHandler("cas", traced(cmd_cas)))
+    app.add_handler(CommandHandler("zona", traced(cmd_zona)))
+    app.add_handler(CommandHandler("stop", traced(cmd_stop)))
+    app.add_handler(CommandHandler("analytika", traced(cmd_analytika)))
+    app.add_handler(CommandHandler("broadcast", traced(cmd_broadcast)))
+
+    app.add_handler(CallbackQueryHandler(traced(on_callback)))
+    app.add_error_handler(on_error)
+    return app
+
 def main():
+    global _db_ready
+
     if not BOT_TOKEN:
         raise RuntimeError("Chybí BOT_TOKEN (nastav jako env proměnnou).")
 
+    STARTUP.mark("telegram_import")
     start_health_server()
-    init_db()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    if WORKERS > 1:
+        init_db()
+        STARTUP.mark("init_db")
+        run_sharded(WORKERS)
+        return
 
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("hod", cmd_hod))
-    app.add_handler(CommandHandler("dnes", cmd_dnes))
-    app.add_handler(CommandHandler("rezim", cmd_rezim))
-    app.add_handler(CommandHandler("historie", cmd_historie))
-    app.add_handler(CommandHandler("stat", cmd_stat))
-    app.add_handler(CommandHandler("cas", cmd_cas))
-    app.add_handler(CommandHandler("stop", cmd_stop))
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="init-db")
+    _db_ready = executor.submit(_timed_init_db)
+    executor.shutdown(wait=False)
 
-    app.add_handler(CallbackQueryHandler(on_callback))
-    app.add_error_handler(on_error)
+    app = build_application()
+    STARTUP.mark("app_build")
 
-    app.run_polling(close_loop=False)
+    app.run_polling(close_loop=False, timeout=TG_POLL_TIMEOUT)
 
 if __name__ == "__main__":
     main()